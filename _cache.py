@@ -0,0 +1,91 @@
+import os
+import hmac
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class _lru_cache:
+    # Bounded, thread-safe LRU cache whose entries also expire after `ttl`
+    # seconds. Every entry is private to this process, so the TTL bounds how
+    # stale a value written by another worker can get.
+    def __init__(self, max_size=10000, ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def epoch(self):
+        # Read before loading a value, pass to set() so that a value loaded
+        # before a concurrent invalidation is never cached
+        return self._epoch
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, epoch=None):
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return False
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions, "expirations": self.expirations, "invalidations": self.invalidations,
+            }
+
+
+class _cache:
+    # Serialized GET /claims/<claim_id> responses keyed by claim id
+    claims = _lru_cache(max_size=int(os.environ.get('CLAIMS_CACHE_SIZE', 10000)),
+                        ttl=float(os.environ.get('CLAIMS_CACHE_TTL', 30)))
+    # Recently verified logins, keyed by identity_key() so no password is kept
+    identities = _lru_cache(max_size=int(os.environ.get('CLAIMS_LOGIN_CACHE_SIZE', 10000)),
+                            ttl=float(os.environ.get('CLAIMS_LOGIN_CACHE_TTL', 60)))
+    _identity_secret = os.urandom(32)
+
+    @staticmethod
+    def identity_key(email, password):
+        return hmac.new(_cache._identity_secret, f"{email}\0{password}".encode(), hashlib.sha256).digest()
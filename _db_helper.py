@@ -1,239 +1,1736 @@
 import sqlite3
 import os
+import glob
+import json
+import heapq
+import itertools
+import queue
+import tempfile
+import threading
+import time
 import logging
-from colorama import Fore, Style, init
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from colorama import Fore
+from _cache import _cache
+from _hasher import _hasher
+from _metrics import _timed_cursor
 
-# Initialize colorama
-init(autoreset=True)
-
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("claims.db")
 
 class _db_query:
+    # Highest id climes ever handed out in the current shard
+    shard_sequence = "COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'climes'), 0)"
+
     @staticmethod
     def check_if_clime_exists(clime_id):
         try:
-            cursor, conn = _db.connect()
-            query = "SELECT * FROM climes WHERE id = ?"
-            cursor.execute(query, (clime_id,))
-            exists = cursor.fetchone() is not None
-            conn.close()
-            return exists
+            for shard in _db.shards_for_id(clime_id):
+                with _db.connect(shard) as (cursor, conn):
+                    query = "SELECT 1 FROM climes WHERE id = ?"
+                    cursor.execute(query, (clime_id,))
+                    if cursor.fetchone() is not None:
+                        return True
+            return False
         except sqlite3.Error as e:
             return False, str(e)
     @staticmethod
     def delete_claim_by_id(clime_id):
+        # The affected row count tells whether the claim existed, no separate lookup
         try:
-            logging.info(Fore.BLUE + f"Attempting to delete clime_id: {clime_id}")
-            if  _db_query.check_if_clime_exists(clime_id):
-                cursor, conn = _db.connect()
-                query = "DELETE FROM climes WHERE id = ?"
-                cursor.execute(query, (clime_id,))
-                conn.commit()
-                conn.close()
-                logging.info(Fore.GREEN + f"Deleted clime_id: {clime_id} successfully")
+            logger.debug(Fore.BLUE + "Attempting to delete clime_id: %s", clime_id)
+            for shard in _db.shards_for_id(clime_id):
+                with _db.connect(shard) as (cursor, conn):
+                    query = "DELETE FROM climes WHERE id = ?"
+                    cursor.execute(query, (clime_id,))
+                    deleted = cursor.rowcount > 0
+                    if not deleted:
+                        conn.commit()
+                        deleted = _archive.modify(cursor, conn, clime_id, delete=True)
+                if deleted:
+                    break
+            if deleted:
+                _cache.claims.invalidate(clime_id)
+                logger.debug(Fore.GREEN + "Deleted clime_id: %s successfully", clime_id)
                 return True, "Deleted successfully"
             return False , "clime isnt exists"
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error deleting clime_id: {clime_id} - {e}")
+            logger.error(Fore.RED + "Error deleting clime_id: %s - %s", clime_id, e)
             return False, str(e)
 
     @staticmethod
     def update_claim_status(status, claim_id):
         try:
-            logging.info(Fore.BLUE + f"Updating status of claim_id: {claim_id} to {status}")
-            cursor, conn = _db.connect()
-            query = "UPDATE climes SET status = ? WHERE id = ?"
-            cursor.execute(query, (status, claim_id))
-            conn.commit()
-            conn.close()
-            logging.info(Fore.GREEN + f"Updated claim_id: {claim_id} successfully")
+            logger.debug(Fore.BLUE + "Updating status of claim_id: %s to %s", claim_id, status)
+            for shard in _db.shards_for_id(claim_id):
+                with _db.connect(shard) as (cursor, conn):
+                    query = "UPDATE climes SET status = ? WHERE id = ?"
+                    cursor.execute(query, (status, claim_id))
+                    updated = cursor.rowcount > 0
+                    if not updated:
+                        conn.commit()
+                        updated = _archive.modify(cursor, conn, claim_id, status=status)
+                if updated:
+                    break
+            if not updated:
+                logger.warning(Fore.YELLOW + "No claim found with ID %s", claim_id)
+                return False, f"No claim found with ID {claim_id}"
+            _cache.claims.invalidate(claim_id)
+            logger.debug(Fore.GREEN + "Updated claim_id: %s successfully", claim_id)
             return True, "Updated successfully"
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error updating status of claim_id: {claim_id} - {e}")
+            logger.error(Fore.RED + "Error updating status of claim_id: %s - %s", claim_id, e)
+            return False, str(e)
+
+    @staticmethod
+    def _bulk_target(ids=None, filters=None):
+        # WHERE clause and parameters selecting either an explicit id list,
+        # expanded in SQL by json_each, or every claim matching the filters
+        if ids is not None:
+            return "id IN (SELECT value FROM json_each(?))", [json.dumps(ids)]
+        clauses, params = _db_query._claim_filters(**filters)
+        return " AND ".join(clauses), params
+
+    @staticmethod
+    def _bulk_partitions(cursor, ids=None):
+        # Archive partitions a bulk statement can touch, only those whose id
+        # range holds one of `ids` when they are given
+        if ids is None:
+            return _archive.partitions(cursor)
+        if not ids:
+            return []
+        return _archive.partitions(cursor, min(ids) - 1, max(ids))
+
+    @staticmethod
+    def update_claims_status(status, ids=None, filters=None):
+        # One set-based UPDATE per shard, run in parallel, applied to the
+        # shard's archive partitions in the same transaction, or one per group
+        # of partitions when they cannot all be attached at once. Returns the
+        # ids it changed.
+        try:
+            logger.debug(Fore.BLUE + "Updating status of claims in bulk to %s", status)
+            where, params = _db_query._bulk_target(ids, filters)
+
+            def update(shard):
+                updated = []
+                with _db.connect(shard) as (cursor, conn):
+                    for number, group in enumerate(_archive.groups(conn, _db_query._bulk_partitions(cursor, ids))):
+                        with _archive.attached(cursor, conn, group) as aliases:
+                            cursor.execute("BEGIN IMMEDIATE")
+                            if number == 0:
+                                cursor.execute(f"UPDATE climes SET status = ? WHERE {where} RETURNING id", (status, *params))
+                                updated.extend(row[0] for row in cursor.fetchall())
+                            updated.extend(_archive.modify_where(cursor, aliases, where, params, status=status))
+                return updated
+            updated = [claim_id for ids in _db.fan_out(update) for claim_id in ids]
+            _cache.claims.invalidate(*updated)
+            logger.debug(Fore.GREEN + "Updated %s claims successfully", len(updated))
+            return True, updated
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error updating claims in bulk - %s", e)
             return False, str(e)
+
+    @staticmethod
+    def delete_claims(ids=None, filters=None):
+        # One set-based DELETE per shard, run in parallel, applied to the
+        # shard's archive partitions like update_claims_status(). Returns the
+        # ids it removed.
+        try:
+            logger.debug(Fore.BLUE + "Deleting claims in bulk")
+            where, params = _db_query._bulk_target(ids, filters)
+
+            def delete(shard):
+                deleted = []
+                with _db.connect(shard) as (cursor, conn):
+                    for number, group in enumerate(_archive.groups(conn, _db_query._bulk_partitions(cursor, ids))):
+                        with _archive.attached(cursor, conn, group) as aliases:
+                            cursor.execute("BEGIN IMMEDIATE")
+                            if number == 0:
+                                cursor.execute(f"DELETE FROM climes WHERE {where} RETURNING id", params)
+                                deleted.extend(row[0] for row in cursor.fetchall())
+                            deleted.extend(_archive.modify_where(cursor, aliases, where, params, delete=True))
+                return deleted
+            deleted = [claim_id for ids in _db.fan_out(delete) for claim_id in ids]
+            _cache.claims.invalidate(*deleted)
+            logger.debug(Fore.GREEN + "Deleted %s claims successfully", len(deleted))
+            return True, deleted
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error deleting claims in bulk - %s", e)
+            return False, str(e)
+
     @staticmethod
     def retrieve_claim_by_id(claim_id):
         try:
-            logging.info(Fore.BLUE + f"Retrieving claim by id: {claim_id}")
-            cursor, conn = _db.connect()
-            query = "SELECT * FROM climes WHERE id = ?"
-            cursor.execute(query, (claim_id,))
-            claim = cursor.fetchone()
-            conn.close()
+            logger.debug(Fore.BLUE + "Retrieving claim by id: %s", claim_id)
+            for shard in _db.shards_for_id(claim_id):
+                with _db.connect(shard) as (cursor, conn):
+                    query = "SELECT * FROM climes WHERE id = ?"
+                    cursor.execute(query, (claim_id,))
+                    claim = cursor.fetchone()
+                    if claim is None:
+                        claim = _archive.find(cursor, conn, claim_id)
+                if claim:
+                    break
             if claim:
-                logging.info(Fore.GREEN + f"Retrieved claim_id: {claim_id} successfully")
+                logger.debug(Fore.GREEN + "Retrieved claim_id: %s successfully", claim_id)
                 return True, claim
             else:
-                logging.warning(Fore.YELLOW + f"No claim found with ID {claim_id}")
+                logger.warning(Fore.YELLOW + "No claim found with ID %s", claim_id)
                 return False, f"No claim found with ID {claim_id}"
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error retrieving claim by id: {claim_id} - {e}")
+            logger.error(Fore.RED + "Error retrieving claim by id: %s - %s", claim_id, e)
             return False, str(e)
 
     @staticmethod
-    def get_claim_data_report(status):
+    def claim_versions(claim_id):
+        # Per-status data versions of the shards that can hold claim_id, shared
+        # by every process. Any write to a claim bumps the version of the status
+        # it had, so a copy of the claim is current while that version holds.
         try:
-            print(status)
-            logging.info(Fore.BLUE + "Retrieving all claims")
-            cursor, conn = _db.connect()
-            query = '''SELECT patient_name, diagnosis_code, procedure_code, status, SUM(claim_amount) AS total_claim_amount
-                FROM climes 
-                WHERE status = ?
-                GROUP BY patient_name, diagnosis_code, procedure_code, status;'''
-            cursor.execute(query,(status,))
-            claims = cursor.fetchall()
-            conn.close()
-            logging.info(Fore.GREEN + "Retrieved all claims successfully")
-            return True, claims
+            versions = {}
+            for shard in _db.shards_for_id(claim_id):
+                with _db.connect(shard) as (cursor, conn):
+                    cursor.execute("SELECT status, version FROM claim_versions")
+                    for status, version in cursor.fetchall():
+                        versions[status] = versions.get(status, 0) + version
+            return True, versions
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error reading claim versions for claim_id: %s - %s", claim_id, e)
+            return False, str(e)
+
+    @staticmethod
+    def count_claim_data_report(status):
+        # With several shards this is an upper bound: a group whose claims sit
+        # in more than one shard is merged into a single report row
+        def count(shard):
+            with _db.connect(shard) as (cursor, conn):
+                query = "SELECT COUNT(*) FROM claim_totals WHERE status = ?"
+                cursor.execute(query, (status,))
+                return cursor.fetchone()[0]
+        try:
+            return True, sum(_db.fan_out(count))
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error retrieving claims - {e}")
+            logger.error(Fore.RED + "Error counting report rows - %s", e)
             return False, str(e)
 
+    @staticmethod
+    def iter_claim_data_report(status, chunk_size=1000):
+        # Yield the grouped report rows in chunks of `chunk_size` so callers can
+        # write them out without ever holding the whole result in memory. The
+        # totals are read from claim_totals, which triggers keep up to date.
+        # Errors propagate to the caller, which is already streaming.
+        logger.debug(Fore.BLUE + "Streaming report rows for status: %s", status)
+        if _db.shards == 1:
+            yield from _db_query._report_chunks(0, status, chunk_size)
+        else:
+            # Every shard streams its rows in key order, read ahead on the shard
+            # executor, and groups found in several shards are summed
+            streams = [itertools.chain.from_iterable(_db.read_ahead(_db_query._report_chunks(shard, status, chunk_size)))
+                       for shard in range(_db.shards)]
+            claims, last = [], None
+            for row in heapq.merge(*streams, key=lambda row: row[:3]):
+                if last is not None and row[:3] == last[:3]:
+                    last = (*last[:4], last[4] + row[4])
+                    continue
+                if last is not None:
+                    claims.append(last)
+                    if len(claims) >= chunk_size:
+                        yield claims
+                        claims = []
+                last = row
+            if last is not None:
+                claims.append(last)
+            if claims:
+                yield claims
+        logger.debug(Fore.GREEN + "Streamed report rows successfully")
+
+    @staticmethod
+    def _report_chunks(shard, status, chunk_size):
+        with _db.connect(shard) as (cursor, conn):
+            query = '''SELECT patient_name, diagnosis_code, procedure_code, status, total_claim_amount
+                FROM claim_totals
+                WHERE status = ?
+                ORDER BY patient_name, diagnosis_code, procedure_code'''
+            cursor.execute(query, (status,))
+            while True:
+                claims = cursor.fetchmany(chunk_size)
+                if not claims:
+                    break
+                yield claims
+
+    @staticmethod
+    def _claim_filters(diagnosis_code=None, procedure_code=None, status=None):
+        # Only filter on the values that were provided so the query can be
+        # served by idx_climes_status_codes instead of a full scan
+        clauses, params = [], []
+        for column, value in (("status", status), ("diagnosis_code", diagnosis_code), ("procedure_code", procedure_code)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return clauses, params
+
+    @staticmethod
     def get_claim_data(limit, page, diagnosis_code=None, procedure_code=None, status=None):
         try:
-            logging.info(Fore.BLUE + "Retrieving claims with filters")
-            cursor, conn = _db.connect()
-            query = '''SELECT * FROM climes WHERE 
-                        (diagnosis_code = ? OR diagnosis_code IS NULL) AND 
-                        (procedure_code = ? OR procedure_code IS NULL) AND
-                        (status = ? OR status IS NULL)
-                        LIMIT ? OFFSET ?;'''
-
-            params = (diagnosis_code, procedure_code, status, limit, (page - 1) * limit)
-            cursor.execute(query, params)
-            claims = cursor.fetchall()
-            conn.close()
-            logging.info(Fore.GREEN + "Retrieved claims with filters successfully")
+            logger.debug(Fore.BLUE + "Retrieving claims with filters")
+            clauses, params = _db_query._claim_filters(diagnosis_code, procedure_code, status)
+            offset = (page - 1) * limit
+            with ExitStack() as stack:
+                sources = []
+                for shard in range(_db.shards):
+                    # Each shard reads its hot rows and partitions in one query,
+                    # or one per group of partitions a connection can attach
+                    cursor, conn = stack.enter_context(_db.connect(shard))
+                    for number, group in enumerate(_archive.groups(conn, _archive.partitions(cursor))):
+                        if number > 0:
+                            cursor, conn = stack.enter_context(_db.connect_spare(shard))
+                        aliases = stack.enter_context(_archive.attached(cursor, conn, group))
+                        sources.append((cursor, *_archive.union(aliases, clauses, params, hot=number == 0)))
+                if len(sources) == 1:
+                    cursor, query, query_params = sources[0]
+                    cursor.execute(f"{query} ORDER BY id LIMIT ? OFFSET ?", (*query_params, limit, offset))
+                    claims = cursor.fetchall()
+                else:
+                    # Any source may hold rows before the page: the sources are
+                    # merged as they stream, skipped rows are never kept
+                    for cursor, query, query_params in sources:
+                        cursor.execute(f"{query} ORDER BY id LIMIT ?", (*query_params, offset + limit))
+                    streams = [cursor for cursor, query, query_params in sources]
+                    claims = list(itertools.islice(_db.unique_by_id(streams), offset, offset + limit))
+            logger.debug(Fore.GREEN + "Retrieved claims with filters successfully")
             return True, claims
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error retrieving claims with filters - {e}")
+            logger.error(Fore.RED + "Error retrieving claims with filters - %s", e)
             return False, str(e)
 
+    @staticmethod
+    def get_claim_data_after(limit, after_id=0, diagnosis_code=None, procedure_code=None, status=None):
+        # Keyset pagination on id: every page is an index seek, however deep it
+        # is. Returns the id to continue after, or None on the last page.
+        try:
+            logger.debug(Fore.BLUE + "Retrieving claims with filters after id: %s", after_id)
+            clauses, params = _db_query._claim_filters(diagnosis_code, procedure_code, status)
+            clauses.append("id > ?")
+            params.append(after_id)
+            # Fetch one extra row to know whether another page exists
+            claims = _db_query._first_claims(clauses, params, limit + 1, after_id)
+            next_id = claims[limit - 1][0] if len(claims) > limit else None
+            logger.debug(Fore.GREEN + "Retrieved claims with filters successfully")
+            return True, claims[:limit], next_id
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error retrieving claims with filters - %s", e)
+            return False, str(e), None
+
+    @staticmethod
+    def _first_claims(clauses, params, limit, after_id=None):
+        # The first `limit` claims matching `clauses` by id, read from every
+        # shard in parallel, archived claims included
+        def first(shard):
+            where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+            with _db.connect(shard) as (cursor, conn):
+                cursor.execute(f"SELECT * FROM climes {where} ORDER BY id LIMIT ?", (*params, limit))
+                return _archive.spanning(cursor, conn, cursor.fetchall(), clauses, params, limit, after_id)
+        results = _db.fan_out(first)
+        return results[0] if len(results) == 1 else _db.merge_by_id(results, limit)
+
+    @staticmethod
+    def _search_expression(text, match='prefix'):
+        # FTS5 query requiring every word of `text`. Words are quoted so input
+        # is never parsed as query syntax: in prefix mode each one must start a
+        # word of the name, in fuzzy mode it may appear anywhere in it.
+        words = [word.replace('"', '""') for word in text.split() if any(char.isalnum() for char in word)]
+        if match == 'fuzzy':
+            return "climes_trigram", " AND ".join(f'"{word}"' for word in words)
+        return "climes_fts", " AND ".join(f'"{word}"*' for word in words)
+
+    @staticmethod
+    def search_claims(text, limit, after_id=0, match='prefix', diagnosis_code=None, procedure_code=None, status=None):
+        # Claims whose patient name matches `text`, served by the full text
+        # indexes and combined with the usual filters. Pages on id like
+        # get_claim_data_after(): the index yields matches in id order, so a
+        # page never scores or sorts the whole match set.
+        try:
+            logger.debug(Fore.BLUE + "Searching claims for %r after id: %s", text, after_id)
+            table, expression = _db_query._search_expression(text, match)
+            clauses, params = _db_query._claim_filters(diagnosis_code, procedure_code, status)
+            filters = "".join(f" AND claim.{clause}" for clause in clauses)
+
+            def search(shard):
+                with _db.connect(shard) as (cursor, conn):
+                    query = f'''SELECT claim.* FROM {table} JOIN climes AS claim ON claim.id = {table}.rowid
+                        WHERE {table} MATCH ? AND {table}.rowid > ?{filters} ORDER BY {table}.rowid LIMIT ?'''
+                    # Fetch one extra row to know whether another page exists
+                    cursor.execute(query, (expression, after_id, *params, limit + 1))
+                    return cursor.fetchall()
+            results = _db.fan_out(search)
+            claims = results[0] if len(results) == 1 else _db.merge_by_id(results, limit + 1)
+            next_id = claims[limit - 1][0] if len(claims) > limit else None
+            logger.debug(Fore.GREEN + "Searched claims successfully")
+            return True, claims[:limit], next_id
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error searching claims - %s", e)
+            return False, str(e), None
+
     @staticmethod
     def add_claim(patient_name, diagnosis_code, procedure_code, claim_amount):
         try:
-            logging.info(Fore.BLUE + "Adding new claim")
-            cursor, conn = _db.connect()
-            query = "INSERT INTO climes (patient_name, diagnosis_code, procedure_code, claim_amount) VALUES (?, ?, ?, ?)"
-            cursor.execute(query, (patient_name, diagnosis_code, procedure_code, claim_amount))
-            if cursor.rowcount > 0:  # Check if a row was inserted
-                conn.commit()
-                conn.close()
-                logging.info(Fore.GREEN + "Claim added successfully")
+            logger.debug(Fore.BLUE + "Adding new claim")
+            shard = _db.shard_for_patient(patient_name)
+            with _db.connect(shard) as (cursor, conn):
+                if _db.shards == 1:
+                    query = "INSERT INTO climes (patient_name, diagnosis_code, procedure_code, claim_amount) VALUES (?, ?, ?, ?)"
+                    cursor.execute(query, (patient_name, diagnosis_code, procedure_code, claim_amount))
+                else:
+                    # The next id after this shard's sequence that routes back to it
+                    query = f'''INSERT INTO climes (id, patient_name, diagnosis_code, procedure_code, claim_amount)
+                        VALUES (({_db_query.shard_sequence} / ? + 1) * ? + ?, ?, ?, ?, ?)'''
+                    cursor.execute(query, (_db.shards, _db.shards, shard, patient_name, diagnosis_code, procedure_code, claim_amount))
+                inserted = cursor.rowcount > 0  # Check if a row was inserted
+            if inserted:
+                logger.debug(Fore.GREEN + "Claim added successfully")
                 return True, "Claim created successfully"
             else:
-                conn.close()
-                logging.warning(Fore.YELLOW + "Failed to create claim")
+                logger.warning(Fore.YELLOW + "Failed to create claim")
                 return False, "Failed to create claim"
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error adding claim - {e}")
+            logger.error(Fore.RED + "Error adding claim - %s", e)
+            return False, str(e)
+
+    @staticmethod
+    def add_claims_batch(claims):
+        # Insert a batch of (patient_name, diagnosis_code, procedure_code, claim_amount)
+        # tuples, one transaction per shard with the shards written in parallel.
+        # Returns (ok, ranges, failed): the (first, last) ids inserted in each
+        # shard and the error for every position of a shard that failed.
+        logger.debug(Fore.BLUE + "Adding batch of %s claims", len(claims))
+        groups = {}
+        if _db.shards == 1:
+            groups[0] = list(range(len(claims)))
+        else:
+            for position, claim in enumerate(claims):
+                groups.setdefault(_db.shard_for_patient(claim[0]), []).append(position)
+
+        def insert(shard):
+            try:
+                return _db_query._insert_claims(shard, [claims[position] for position in groups[shard]]), None
+            except sqlite3.Error as e:
+                logger.error(Fore.RED + "Error adding batch of claims to shard %s - %s", shard, e)
+                return None, str(e)
+        ranges, failed = [], {}
+        for shard, (id_range, error) in zip(groups, _db.fan_out(insert, list(groups))):
+            if error is None:
+                ranges.append(id_range)
+            else:
+                failed.update(dict.fromkeys(groups[shard], error))
+        if not failed:
+            logger.debug(Fore.GREEN + "Added batch of %s claims successfully", len(claims))
+        return not failed, ranges, failed
+
+    @staticmethod
+    def _insert_claims(shard, claims):
+        # Insert claims into one shard in a single transaction, returns the
+        # (first, last) ids. The write lock is held for the whole batch, so the
+        # ids form a contiguous run, stepping by the shard count.
+        # The search indexes take the whole batch in one statement each.
+        with _db.connect(shard) as (cursor, conn):
+            cursor.execute("BEGIN IMMEDIATE")
+            with _search.paused(cursor) as ranges:
+                if _db.shards == 1:
+                    query = "INSERT INTO climes (patient_name, diagnosis_code, procedure_code, claim_amount) VALUES (?, ?, ?, ?)"
+                    cursor.executemany(query, claims)
+                    cursor.execute("SELECT last_insert_rowid()")
+                    last_id = cursor.fetchone()[0]
+                    ranges.append((last_id - len(claims) + 1, last_id))
+                else:
+                    cursor.execute(f"SELECT {_db_query.shard_sequence}")
+                    first_id = (cursor.fetchone()[0] // _db.shards + 1) * _db.shards + shard
+                    ids = range(first_id, first_id + len(claims) * _db.shards, _db.shards)
+                    query = "INSERT INTO climes (id, patient_name, diagnosis_code, procedure_code, claim_amount) VALUES (?, ?, ?, ?, ?)"
+                    cursor.executemany(query, [(claim_id, *claim) for claim_id, claim in zip(ids, claims)])
+                    ranges.append((ids[0], ids[-1]))
+            return ranges[0]
+
+    @staticmethod
+    def create_report_job(job_id, status, format='csv'):
+        try:
+            with _db.connect() as (cursor, conn):
+                query = "INSERT INTO report_jobs (id, status, format, state, created_at) VALUES (?, ?, ?, 'queued', ?)"
+                cursor.execute(query, (job_id, status, format, time.time()))
+            return True, job_id
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error creating report job %s - %s", job_id, e)
+            return False, str(e)
+
+    @staticmethod
+    def find_or_create_report_job(job_id, status, format, stale_before):
+        # Single flight: in one write transaction, return the newest job for the
+        # same status, format and data version that is completed or still alive,
+        # or record job_id as a new queued job. Returns (True, (job, created)).
+        def data_version(shard):
+            with _db.connect(shard) as (cursor, conn):
+                cursor.execute("SELECT COALESCE((SELECT version FROM claim_versions WHERE status = ?), 0)", (status,))
+                return cursor.fetchone()[0]
+        try:
+            # Every shard counts its own changes, their sum only ever grows
+            others = sum(_db.fan_out(data_version, range(1, _db.shards))) if _db.shards > 1 else 0
+            with _db.connect() as (cursor, conn):
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute("SELECT COALESCE((SELECT version FROM claim_versions WHERE status = ?), 0)", (status,))
+                version = cursor.fetchone()[0] + others
+                query = '''SELECT * FROM report_jobs
+                    WHERE status = ? AND format = ? AND data_version = ?
+                        AND (state = 'completed' OR (state IN ('queued', 'in progress') AND COALESCE(updated_at, created_at) >= ?))
+                    ORDER BY created_at DESC LIMIT 1'''
+                cursor.execute(query, (status, format, version, stale_before))
+                row = cursor.fetchone()
+                if row is not None:
+                    return True, (dict(zip((column[0] for column in cursor.description), row)), False)
+                query = "INSERT INTO report_jobs (id, status, format, data_version, state, created_at) VALUES (?, ?, ?, ?, 'queued', ?)"
+                cursor.execute(query, (job_id, status, format, version, time.time()))
+                return True, ({"id": job_id, "state": "queued"}, True)
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error finding or creating report job for status %s - %s", status, e)
+            return False, str(e)
+
+    @staticmethod
+    def expire_report_job(job_id):
+        # Mark a completed job's artifacts as removed, True only for the caller
+        # that made the change so files are deleted exactly once
+        try:
+            with _db.connect() as (cursor, conn):
+                cursor.execute("UPDATE report_jobs SET state = 'expired', updated_at = ? WHERE id = ? AND state = 'completed'",
+                               (time.time(), job_id))
+                return True, cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error expiring report job %s - %s", job_id, e)
+            return False, str(e)
+
+    @staticmethod
+    def get_completed_report_jobs():
+        # Completed jobs, most recently used first, for artifact eviction
+        try:
+            with _db.connect() as (cursor, conn):
+                query = '''SELECT id, format, path, bytes, finished_at, COALESCE(accessed_at, finished_at) AS last_used
+                    FROM report_jobs WHERE state = 'completed' ORDER BY last_used DESC'''
+                cursor.execute(query)
+                return True, [dict(zip((column[0] for column in cursor.description), row)) for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error listing completed report jobs - %s", e)
+            return False, str(e)
+
+    @staticmethod
+    def update_report_job(job_id, **fields):
+        # Set the given report_jobs columns, updated_at doubles as the heartbeat
+        fields["updated_at"] = time.time()
+        try:
+            with _db.connect() as (cursor, conn):
+                assignments = ", ".join(f"{column} = ?" for column in fields)
+                cursor.execute(f"UPDATE report_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+                return cursor.rowcount > 0, job_id
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error updating report job %s - %s", job_id, e)
+            return False, str(e)
+
+    @staticmethod
+    def get_report_job(job_id):
+        try:
+            with _db.connect() as (cursor, conn):
+                cursor.execute("SELECT * FROM report_jobs WHERE id = ?", (job_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return False, f"No report job found with ID {job_id}"
+                return True, dict(zip((column[0] for column in cursor.description), row))
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error retrieving report job %s - %s", job_id, e)
             return False, str(e)
 
     @staticmethod
     def login(email, password):
+        # A single indexed lookup by email, the password is checked off-thread
+        # by _hasher. Successful logins are remembered briefly so reconnect
+        # storms skip both the query and the hash. _hasher.Busy propagates.
         try:
-            logging.info(Fore.BLUE + f"Logging in user with email: {email}")
-            cursor, conn = _db.connect()
-            query = "SELECT * FROM users WHERE email = ? AND password = ?"
-            cursor.execute(query, (email, password))
-            user_exists = cursor.fetchone() is not None
-            conn.close()
-            if user_exists:
-                logging.info(Fore.GREEN + "User logged in successfully")
+            logger.debug(Fore.BLUE + "Logging in user with email: %s", email)
+            identity = _cache.identity_key(email, password)
+            if _cache.identities.get(identity):
+                return True
+            with _db.connect() as (cursor, conn):
+                query = "SELECT password FROM users WHERE email = ?"
+                cursor.execute(query, (email,))
+                user = cursor.fetchone()
+            matches, needs_rehash = _hasher.verify(password, user[0] if user else _hasher.dummy())
+            if matches and user:
+                if needs_rehash:
+                    _db_query.update_password(email, password)
+                _cache.identities.set(identity, True)
+                logger.debug(Fore.GREEN + "User logged in successfully")
                 return True
             else:
-                logging.warning(Fore.YELLOW + "Login failed - Invalid credentials")
+                logger.warning(Fore.YELLOW + "Login failed - Invalid credentials")
                 return False
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error during login - {e}")
+            logger.error(Fore.RED + "Error during login - %s", e)
+            return False
+
+    @staticmethod
+    def update_password(email, password):
+        # Store a fresh hash, used to upgrade legacy plaintext passwords and
+        # hashes made with an outdated iteration count
+        try:
+            with _db.connect() as (cursor, conn):
+                query = "UPDATE users SET password = ? WHERE email = ?"
+                cursor.execute(query, (_hasher.hash(password), email))
+            return True, "Password updated successfully"
+        except sqlite3.Error as e:
+            logger.error(Fore.RED + "Error updating password - %s", e)
             return False, str(e)
 
     @staticmethod
     def check_exsists_email(email):
         try:
-            logging.info(Fore.BLUE + f"Checking if email exists: {email}")
-            cursor, conn = _db.connect()
-            query = "SELECT * FROM users WHERE email = ?"
-            cursor.execute(query, (email,))
-            result = cursor.fetchone()
-            conn.close()
+            logger.debug(Fore.BLUE + "Checking if email exists: %s", email)
+            with _db.connect() as (cursor, conn):
+                query = "SELECT 1 FROM users WHERE email = ?"
+                cursor.execute(query, (email,))
+                result = cursor.fetchone()
             if result:
-                logging.info(Fore.GREEN + f"Email {email} exists")
+                logger.debug(Fore.GREEN + "Email %s exists", email)
                 return True  # return true if the email already exists
             else:
-                logging.info(Fore.YELLOW + f"Email {email} does not exist")
+                logger.debug(Fore.YELLOW + "Email %s does not exist", email)
                 return False
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error checking email existence - {e}")
+            logger.error(Fore.RED + "Error checking email existence - %s", e)
             return False, str(e)
 
     @staticmethod
     def add_user(name, email, password):
+        # One atomic statement: the unique index on email turns a duplicate
+        # signup into a no-op instead of a separate existence check
         try:
-            logging.info(Fore.BLUE + f"Adding new user with email: {email}")
-            if not _db_query.check_exsists_email(email):
-                cursor, conn = _db.connect()
-                query = "INSERT INTO users (name, email, password) VALUES (?, ?, ?)"
-                cursor.execute(query, (name, email, password))
-                conn.commit()
-                conn.close()
-                logging.info(Fore.GREEN + "User signed up successfully")
+            logger.debug(Fore.BLUE + "Adding new user with email: %s", email)
+            password_hash = _hasher.hash(password)
+            with _db.connect() as (cursor, conn):
+                query = "INSERT INTO users (name, email, password) VALUES (?, ?, ?) ON CONFLICT (email) DO NOTHING"
+                cursor.execute(query, (name, email, password_hash))
+                created = cursor.rowcount > 0
+            if created:
+                logger.debug(Fore.GREEN + "User signed up successfully")
                 return True, "User signed up successfully"
             else:
-                logging.warning(Fore.YELLOW + f"User signup failed - Email {email} already exists")
+                logger.warning(Fore.YELLOW + "User signup failed - Email %s already exists", email)
                 return False, "Email already exists"
         except sqlite3.Error as e:
-            logging.error(Fore.RED + f"Error adding user - {e}")
+            logger.error(Fore.RED + "Error adding user - %s", e)
             return False, str(e)
 
 
+class _connection_pool:
+    # Thread-safe pool of reusable SQLite connections. Connections are opened
+    # lazily up to `size`, tuned once with the pragmas below and health-checked
+    # every time they are handed out.
+    def __init__(self, path, size=5, timeout=30.0, busy_timeout=5000,
+                 cache_size=-64000, mmap_size=268435456, synchronous='NORMAL'):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA foreign_keys = ON")
+        with self._lock:
+            self._opened += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._opened -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self):
+        # Block until a slot is free so at most `size` connections are ever in use
+        if not self._slots.acquire(timeout=self.timeout):
+            raise sqlite3.OperationalError(f"Timed out waiting for a connection to {self.path}")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._open()
+                if self._is_healthy(conn):
+                    return conn
+                logger.warning(Fore.YELLOW + "Discarding unhealthy connection to %s", self.path)
+                self._discard(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn):
+        try:
+            if self._closed:
+                self._discard(conn)
+                return
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (sqlite3.Error, queue.Full):
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # Close every idle connection, connections currently checked out are
+        # closed as soon as they are released
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+    def stats(self):
+        return {"path": self.path, "size": self.size, "opened": self._opened, "idle": self._idle.qsize()}
+
+
 class _db:
+    path = os.environ.get('CLAIMS_DB_PATH', 'claims.db')
+    # Number of SQLite files climes is spread over, 1 keeps everything in `path`
+    shards = int(os.environ.get('CLAIMS_DB_SHARDS', 1))
+    pool_size = int(os.environ.get('CLAIMS_DB_POOL_SIZE', 5))
+    pool_timeout = float(os.environ.get('CLAIMS_DB_POOL_TIMEOUT', 30))
+    busy_timeout = int(os.environ.get('CLAIMS_DB_BUSY_TIMEOUT_MS', 5000))
+    cache_size = int(os.environ.get('CLAIMS_DB_CACHE_SIZE', -64000))  # negative value is KiB
+    mmap_size = int(os.environ.get('CLAIMS_DB_MMAP_SIZE', 268435456))
+    synchronous = os.environ.get('CLAIMS_DB_SYNCHRONOUS', 'NORMAL')
+    _pools = {}
+    _pool_lock = threading.Lock()
+    _executor = None
+
     @staticmethod
     def check_exists_db():
-        return os.path.exists('claims.db')
+        return os.path.exists(_db.path)
 
     @staticmethod
-    def connect():
-        conn = sqlite3.connect('claims.db')
-        cursor = conn.cursor()
-        return cursor, conn
+    def configure(**options):
+        # Override any of the class level settings and drop the current pool so
+        # the next connection picks them up
+        for key, value in options.items():
+            if not hasattr(_db, key) or key.startswith('_'):
+                raise AttributeError(f"Unknown database option: {key}")
+            setattr(_db, key, value)
+        _db.close_pool()
 
-def _init__db():
-    clime_query = '''
-    CREATE TABLE IF NOT EXISTS climes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_name TEXT NOT NULL,
-        diagnosis_code INT NOT NULL,
-        procedure_code INT NOT NULL,
-        claim_amount REAL NOT NULL,
-        status INTEGER NOT NULL DEFAULT 2,
-        submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    );
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        email TEXT NOT NULL,
-        password TEXT NOT NULL
-    );
-    '''
-    if not _db.check_exists_db():
-        cursor, conn = _db.connect()
-        try:
-            cursor.executescript(clime_query)
+    @staticmethod
+    def shard_path(shard):
+        # Shard 0 is the main database, which also keeps users and report jobs,
+        # shard k is <stem>_shard_<k>.db next to it
+        if shard == 0:
+            return _db.path
+        stem, extension = os.path.splitext(_db.path)
+        return f"{stem}_shard_{shard}{extension or '.db'}"
+
+    @staticmethod
+    def existing_shards():
+        # Configured shards plus any shard file left on disk by a layout with more shards
+        stem, extension = os.path.splitext(_db.path)
+        extension = extension or '.db'
+        found = set(range(_db.shards))
+        for path in glob.glob(f"{glob.escape(stem)}_shard_*{extension}"):
+            suffix = path[len(stem) + len("_shard_"):-len(extension)]
+            if suffix.isdigit():
+                found.add(int(suffix))
+        return sorted(found)
+
+    @staticmethod
+    def shard_for_id(claim_id):
+        return claim_id % _db.shards
+
+    @staticmethod
+    def shard_for_patient(patient_name):
+        # New claims are placed by patient so one patient's claims share a
+        # shard; crc32 is stable across processes, unlike hash()
+        return zlib.crc32(patient_name.encode('utf-8')) % _db.shards
+
+    @staticmethod
+    def shards_for_id(claim_id):
+        # The shard an id routes to, then the others for rows written before
+        # the last rebalance, only visited when the id is not found
+        home = _db.shard_for_id(claim_id)
+        return [home, *(shard for shard in range(_db.shards) if shard != home)]
+
+    @staticmethod
+    def pool(shard=0):
+        pool = _db._pools.get(shard)
+        if pool is None:
+            with _db._pool_lock:
+                pool = _db._pools.get(shard)
+                if pool is None:
+                    pool = _db._pools[shard] = _connection_pool(
+                        _db.shard_path(shard), size=_db.pool_size, timeout=_db.pool_timeout,
+                        busy_timeout=_db.busy_timeout, cache_size=_db.cache_size,
+                        mmap_size=_db.mmap_size, synchronous=_db.synchronous)
+        return pool
+
+    @staticmethod
+    @contextmanager
+    def connect_spare(shard=0):
+        # A connection of its own, outside the pool, for a read that needs
+        # more databases attached than one connection takes. Closed afterwards.
+        pool = _db.pool(shard)
+        conn = pool._open()
+        try:
+            yield _timed_cursor(conn.cursor()), conn
+        finally:
+            pool._discard(conn)
+
+    @staticmethod
+    def close_pool():
+        with _db._pool_lock:
+            pools, _db._pools = _db._pools, {}
+            executor, _db._executor = _db._executor, None
+        for pool in pools.values():
+            pool.close()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _reset_after_fork():
+        # Connections must never be shared with a forked child, forget them
+        # without closing so the parent's handles stay intact
+        _db._pools = {}
+        _db._pool_lock = threading.Lock()
+        _db._executor = None
+
+    @staticmethod
+    def executor():
+        # Threads running one query per shard, SQLite releases the GIL while it works
+        if _db._executor is None:
+            with _db._pool_lock:
+                if _db._executor is None:
+                    _db._executor = ThreadPoolExecutor(max_workers=_db.shards * _db.pool_size, thread_name_prefix="claims-shard")
+        return _db._executor
+
+    @staticmethod
+    def fan_out(function, shards=None):
+        # Call function(shard) for every shard, in parallel when there are
+        # several, and return the results in shard order
+        shards = range(_db.shards) if shards is None else shards
+        if len(shards) == 1:
+            return [function(shards[0])]
+        futures = [_db.executor().submit(function, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def read_ahead(chunks):
+        # Fetch the next chunk on the shard executor while the caller works
+        # through the current one
+        executor = _db.executor()
+        future = executor.submit(next, chunks, None)
+        try:
+            while True:
+                chunk = future.result()
+                if chunk is None:
+                    return
+                future = executor.submit(next, chunks, None)
+                yield chunk
+        finally:
+            # Let a fetch in flight finish before closing the generator it runs
+            if not future.cancel():
+                future.exception()
+            chunks.close()
+
+    @staticmethod
+    def unique_by_id(streams):
+        # Lazily merge iterables of rows ordered by id. A row present twice,
+        # copied by an interrupted archival or rebalance run, is kept once.
+        last_id = None
+        for row in heapq.merge(*streams, key=lambda row: row[0]):
+            if row[0] != last_id:
+                last_id = row[0]
+                yield row
+
+    @staticmethod
+    def merge_by_id(results, limit):
+        # Merge lists of rows ordered by id into the first `limit` rows
+        return list(itertools.islice(_db.unique_by_id(results), limit))
+
+    @staticmethod
+    def align_sequences():
+        # Raise every shard's climes sequence to the highest one, so ids handed
+        # out after shards are added never collide with rows not moved yet
+        if _db.shards == 1:
+            return
+
+        def read(shard):
+            with _db.connect(shard) as (cursor, conn):
+                cursor.execute(f"SELECT {_db_query.shard_sequence}")
+                return cursor.fetchone()[0]
+
+        def align(shard):
+            with _db.connect(shard) as (cursor, conn):
+                cursor.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'climes' AND seq < ?", (highest, highest))
+                cursor.execute('''INSERT INTO sqlite_sequence (name, seq) SELECT 'climes', ?
+                    WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'climes')''', (highest,))
+        highest = max(_db.fan_out(read))
+        _db.fan_out(align)
+
+    @staticmethod
+    @contextmanager
+    def connect(shard=0):
+        # Borrow a pooled connection: commit when the block succeeds, roll back
+        # when it raises, and always hand the connection back to the pool
+        pool = _db.pool(shard)
+        conn = pool.acquire()
+        try:
+            yield _timed_cursor(conn.cursor()), conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            pool.release(conn)
+
+    @staticmethod
+    def health_check():
+        try:
+            for shard in range(_db.shards):
+                with _db.connect(shard) as (cursor, conn):
+                    cursor.execute("SELECT 1")
+                    cursor.fetchone()
+            return True, _db.pool().stats()
+        except sqlite3.Error as e:
+            return False, str(e)
+
+
+os.register_at_fork(after_in_child=_db._reset_after_fork)
+
+class _migrations:
+    # Ordered schema migrations, each one is applied exactly once inside its own
+    # transaction and recorded in the schema_version table. Append new steps to
+    # the end of the list, never edit a step that has already shipped.
+    steps = [
+        (1, "create climes and users tables", [
+            '''CREATE TABLE IF NOT EXISTS climes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patient_name TEXT NOT NULL,
+                diagnosis_code INT NOT NULL,
+                procedure_code INT NOT NULL,
+                claim_amount REAL NOT NULL,
+                status INTEGER NOT NULL DEFAULT 2,
+                submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )''',
+            '''CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                email TEXT NOT NULL,
+                password TEXT NOT NULL
+            )''',
+        ]),
+        (2, "add indexes for claim filters, reports and user lookups", [
+            # Signups used to race, keep the first account of any duplicated email
+            "DELETE FROM users WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY email)",
+            "CREATE INDEX IF NOT EXISTS idx_climes_status_codes ON climes (status, diagnosis_code, procedure_code)",
+            "CREATE INDEX IF NOT EXISTS idx_climes_submitted_at ON climes (submitted_at)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email)",
+        ]),
+        (3, "add durable report job store", [
+            '''CREATE TABLE IF NOT EXISTS report_jobs (
+                id TEXT PRIMARY KEY,
+                status INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                total_rows INTEGER,
+                rows_written INTEGER NOT NULL DEFAULT 0,
+                path TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                updated_at REAL,
+                finished_at REAL
+            )''',
+            "CREATE INDEX IF NOT EXISTS idx_report_jobs_state ON report_jobs (state, created_at)",
+        ]),
+        (4, "add claim_totals aggregate maintained by triggers", [
+            '''CREATE TABLE IF NOT EXISTS claim_totals (
+                status INTEGER NOT NULL,
+                patient_name TEXT NOT NULL,
+                diagnosis_code INT NOT NULL,
+                procedure_code INT NOT NULL,
+                total_claim_amount REAL NOT NULL,
+                claim_count INTEGER NOT NULL,
+                PRIMARY KEY (status, patient_name, diagnosis_code, procedure_code)
+            ) WITHOUT ROWID''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_totals_insert AFTER INSERT ON climes BEGIN
+                INSERT INTO claim_totals (status, patient_name, diagnosis_code, procedure_code, total_claim_amount, claim_count)
+                VALUES (NEW.status, NEW.patient_name, NEW.diagnosis_code, NEW.procedure_code, NEW.claim_amount, 1)
+                ON CONFLICT (status, patient_name, diagnosis_code, procedure_code) DO UPDATE SET
+                    total_claim_amount = total_claim_amount + excluded.total_claim_amount,
+                    claim_count = claim_count + 1;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_totals_delete AFTER DELETE ON climes BEGIN
+                UPDATE claim_totals SET total_claim_amount = total_claim_amount - OLD.claim_amount, claim_count = claim_count - 1
+                WHERE status = OLD.status AND patient_name = OLD.patient_name
+                    AND diagnosis_code = OLD.diagnosis_code AND procedure_code = OLD.procedure_code;
+                DELETE FROM claim_totals
+                WHERE status = OLD.status AND patient_name = OLD.patient_name
+                    AND diagnosis_code = OLD.diagnosis_code AND procedure_code = OLD.procedure_code AND claim_count <= 0;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_totals_update
+            AFTER UPDATE OF status, patient_name, diagnosis_code, procedure_code, claim_amount ON climes BEGIN
+                UPDATE claim_totals SET total_claim_amount = total_claim_amount - OLD.claim_amount, claim_count = claim_count - 1
+                WHERE status = OLD.status AND patient_name = OLD.patient_name
+                    AND diagnosis_code = OLD.diagnosis_code AND procedure_code = OLD.procedure_code;
+                DELETE FROM claim_totals
+                WHERE status = OLD.status AND patient_name = OLD.patient_name
+                    AND diagnosis_code = OLD.diagnosis_code AND procedure_code = OLD.procedure_code AND claim_count <= 0;
+                INSERT INTO claim_totals (status, patient_name, diagnosis_code, procedure_code, total_claim_amount, claim_count)
+                VALUES (NEW.status, NEW.patient_name, NEW.diagnosis_code, NEW.procedure_code, NEW.claim_amount, 1)
+                ON CONFLICT (status, patient_name, diagnosis_code, procedure_code) DO UPDATE SET
+                    total_claim_amount = total_claim_amount + excluded.total_claim_amount,
+                    claim_count = claim_count + 1;
+            END''',
+            "DELETE FROM claim_totals",
+            '''INSERT INTO claim_totals (status, patient_name, diagnosis_code, procedure_code, total_claim_amount, claim_count)
+                SELECT status, patient_name, diagnosis_code, procedure_code, SUM(claim_amount), COUNT(*)
+                FROM climes GROUP BY status, patient_name, diagnosis_code, procedure_code''',
+        ]),
+        (5, "add output format to report_jobs", [
+            "ALTER TABLE report_jobs ADD COLUMN format TEXT NOT NULL DEFAULT 'csv'",
+        ]),
+        (6, "add per-status data versions and report cache columns", [
+            "CREATE TABLE IF NOT EXISTS claim_versions (status INTEGER PRIMARY KEY, version INTEGER NOT NULL)",
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_version_insert AFTER INSERT ON climes BEGIN
+                INSERT INTO claim_versions (status, version) VALUES (NEW.status, 1)
+                ON CONFLICT (status) DO UPDATE SET version = version + 1;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_version_delete AFTER DELETE ON climes BEGIN
+                INSERT INTO claim_versions (status, version) VALUES (OLD.status, 1)
+                ON CONFLICT (status) DO UPDATE SET version = version + 1;
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_version_update
+            AFTER UPDATE OF status, patient_name, diagnosis_code, procedure_code, claim_amount ON climes BEGIN
+                INSERT INTO claim_versions (status, version) VALUES (OLD.status, 1)
+                ON CONFLICT (status) DO UPDATE SET version = version + 1;
+                INSERT INTO claim_versions (status, version) SELECT NEW.status, 1 WHERE NEW.status IS NOT OLD.status
+                ON CONFLICT (status) DO UPDATE SET version = version + 1;
+            END''',
+            "ALTER TABLE report_jobs ADD COLUMN data_version INTEGER",
+            "ALTER TABLE report_jobs ADD COLUMN bytes INTEGER",
+            "ALTER TABLE report_jobs ADD COLUMN accessed_at REAL",
+            "CREATE INDEX IF NOT EXISTS idx_report_jobs_lookup ON report_jobs (status, format, data_version, created_at)",
+        ]),
+        (7, "add manifest of archived claim partitions", [
+            """CREATE TABLE IF NOT EXISTS archive_partitions (
+                name TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                min_id INTEGER NOT NULL,
+                max_id INTEGER NOT NULL,
+                min_submitted_at TEXT,
+                max_submitted_at TEXT,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )""",
+        ]),
+        (8, "add full text indexes on patient_name maintained by triggers", [
+            # Word prefixes, case and accent insensitive, with prefix indexes
+            # so two and three letter prefixes are a single lookup
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS climes_fts USING fts5(
+                patient_name, content='climes', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )''',
+            # Substrings anywhere in the name, for the fuzzy search mode
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS climes_trigram USING fts5(
+                patient_name, content='climes', content_rowid='id', tokenize='trigram'
+            )''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_fts_insert AFTER INSERT ON climes BEGIN
+                INSERT INTO climes_fts (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+                INSERT INTO climes_trigram (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_fts_delete AFTER DELETE ON climes BEGIN
+                INSERT INTO climes_fts (climes_fts, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+                INSERT INTO climes_trigram (climes_trigram, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_fts_update AFTER UPDATE OF patient_name ON climes BEGIN
+                INSERT INTO climes_fts (climes_fts, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+                INSERT INTO climes_trigram (climes_trigram, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+                INSERT INTO climes_fts (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+                INSERT INTO climes_trigram (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+            END''',
+            "INSERT INTO climes_fts (climes_fts) VALUES ('rebuild')",
+            "INSERT INTO climes_trigram (climes_trigram) VALUES ('rebuild')",
+        ]),
+        (9, "index bulk inserts in one statement and make the trigram index opt-in", [
+            # Holds a row while a bulk insert indexes its own batch, only ever
+            # inside that insert's transaction
+            "CREATE TABLE IF NOT EXISTS climes_fts_paused (paused INTEGER NOT NULL)",
+            "DROP TRIGGER IF EXISTS trg_climes_fts_insert",
+            "DROP TRIGGER IF EXISTS trg_climes_fts_delete",
+            "DROP TRIGGER IF EXISTS trg_climes_fts_update",
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_fts_insert AFTER INSERT ON climes
+            WHEN NOT EXISTS (SELECT 1 FROM climes_fts_paused) BEGIN
+                INSERT INTO climes_fts (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_fts_delete AFTER DELETE ON climes BEGIN
+                INSERT INTO climes_fts (climes_fts, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS trg_climes_fts_update AFTER UPDATE OF patient_name ON climes BEGIN
+                INSERT INTO climes_fts (climes_fts, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+                INSERT INTO climes_fts (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+            END''',
+            # Built again by _search.configure() when fuzzy search is enabled
+            "DROP TABLE IF EXISTS climes_trigram",
+        ]),
+        (10, "index partial filters in id order for cursor pagination", [
+            # id is the rowid, so these read the matching claims already in id
+            # order and cursor pages need no sort when only some filters are set
+            "CREATE INDEX IF NOT EXISTS idx_climes_status_id ON climes (status, id)",
+            "CREATE INDEX IF NOT EXISTS idx_climes_status_diagnosis_id ON climes (status, diagnosis_code, id)",
+        ]),
+    ]
+
+    # Hot path queries and the index each of them must be served by
+    query_plans = [
+        ("SELECT * FROM climes WHERE status = ? AND diagnosis_code = ? AND procedure_code = ?",
+         (2, 1, 1), "idx_climes_status_codes"),
+        ("SELECT patient_name, diagnosis_code, procedure_code, status, total_claim_amount FROM claim_totals WHERE status = ?",
+         (2,), "PRIMARY KEY"),
+        ("SELECT * FROM climes WHERE status = ? AND diagnosis_code = ? AND procedure_code = ? AND id > ? ORDER BY id LIMIT ?",
+         (2, 1, 1, 0, 50), "idx_climes_status_codes"),
+        ("SELECT * FROM climes WHERE status = ? AND id > ? ORDER BY id LIMIT ?",
+         (2, 0, 50), "idx_climes_status_id"),
+        ("SELECT * FROM climes WHERE status = ? AND diagnosis_code = ? AND id > ? ORDER BY id LIMIT ?",
+         (2, 1, 0, 50), "idx_climes_status_diagnosis_id"),
+        ("SELECT * FROM climes WHERE submitted_at < ?", ("2000-01-01",), "idx_climes_submitted_at"),
+        ("SELECT 1 FROM users WHERE email = ?", ("user@example.com",), "idx_users_email"),
+        ("SELECT rowid FROM climes_fts WHERE climes_fts MATCH ? AND rowid > ? ORDER BY rowid LIMIT ?",
+         ('"smi"*', 0, 50), "VIRTUAL TABLE INDEX"),
+    ]
+
+    @staticmethod
+    def current_version(cursor):
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return cursor.fetchone()[0]
+
+    @staticmethod
+    def apply():
+        # Bring every shard up to date, returns the versions applied by this call
+        applied = set()
+        for shard in range(_db.shards):
+            applied.update(_migrations.apply_shard(shard))
+        _db.align_sequences()
+        return sorted(applied)
+
+    @staticmethod
+    def apply_shard(shard):
+        applied = []
+        with _db.connect(shard) as (cursor, conn):
+            for version, description, statements in _migrations.steps:
+                # BEGIN IMMEDIATE takes the write lock up front, so concurrent
+                # workers starting at the same time apply every step only once
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    if _migrations.current_version(cursor) >= version:
+                        conn.rollback()
+                        continue
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+                logger.info(Fore.GREEN + "[INFO] Applied migration %s to %s: %s", version, _db.shard_path(shard), description)
+                applied.append(version)
+        _search.configure(shard)
+        return applied
+
+    @staticmethod
+    def explain(query, params=()):
+        with _db.connect() as (cursor, conn):
+            cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+            return [row[3] for row in cursor.fetchall()]
+
+    @staticmethod
+    def check_query_plans():
+        # Return (ok, failures) where failures lists every hot path query that
+        # no longer uses its expected index, or sorts its result
+        failures = []
+        for query, params, index in _migrations.query_plans:
+            plan = _migrations.explain(query, params)
+            # A sort step means the index no longer hands rows over in order
+            if not any(index in step for step in plan) or any("TEMP B-TREE" in step for step in plan):
+                failures.append({"query": " ".join(query.split()), "expected_index": index, "plan": plan})
+        failures.extend(_migrations.check_partition_plans())
+        return not failures, failures
+
+    @staticmethod
+    def check_partition_plans():
+        # A scratch history with more yearly partitions than a connection can
+        # attach: every group must attach, merge its sources in id order
+        # instead of sorting them, and the groups together return every row
+        failures = []
+        with tempfile.TemporaryDirectory() as directory:
+            conn = sqlite3.connect(os.path.join(directory, "claims.db"))
+            conn.execute(_archive.schema[0].format(alias="main"))
+            conn.execute("INSERT INTO climes VALUES (0, 'hot', 1, 1, 1.0, 2, NULL)")
             conn.commit()
+            partitions = []
+            for year in range(conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) + 3):
+                partitions.append((str(2000 + year), os.path.join(directory, f"claims_archive_{2000 + year}.db")))
+                conn.execute("ATTACH DATABASE ? AS scratch", (partitions[-1][1],))
+                for statement in _archive.schema:
+                    conn.execute(statement.format(alias="scratch"))
+                conn.execute("INSERT INTO scratch.climes VALUES (?, 'cold', 1, 1, 1.0, 2, NULL)", (year + 1,))
+                conn.commit()
+                conn.execute("DETACH DATABASE scratch")
+            ids = []
+            cursor = conn.cursor()
+            for number, group in enumerate(_archive.groups(conn, partitions)):
+                with _archive.attached(cursor, conn, group) as aliases:
+                    query, params = _archive.union(aliases, ["status = ?"], [2], hot=number == 0)
+                    cursor.execute(f"EXPLAIN QUERY PLAN {query} ORDER BY id LIMIT ?", (*params, 50))
+                    plan = [row[3] for row in cursor.fetchall()]
+                    if len(aliases) + (number == 0) > 1 and not any("MERGE" in step for step in plan):
+                        failures.append({"query": " ".join(query.split()), "expected_index": "MERGE (UNION ALL)", "plan": plan})
+                    cursor.execute(f"{query} ORDER BY id", params)
+                    ids.extend(row[0] for row in cursor.fetchall())
             conn.close()
-            logging.info(Fore.GREEN + "[INFO] Database successfully initialized.")
-            return True
-        except sqlite3.Error as e:
-            logging.error(Fore.RED + f"An error occurred during database initialization: {e}")
-            return f"An error occurred: {e}"
-    else:
+            if sorted(ids) != list(range(len(partitions) + 1)):
+                failures.append({"query": "archive partitions attached in groups", "expected_index": "every row", "plan": sorted(ids)})
+        return failures
+
+
+class _search:
+    # Full text indexes on patient_name. The word index always exists; the
+    # trigram index behind fuzzy search costs about as much again on every
+    # insert, so it is only kept while fuzzy search is enabled.
+    fuzzy = os.environ.get('CLAIMS_SEARCH_FUZZY', '').lower() in ('1', 'true', 'yes')
+    trigram_statements = [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS climes_trigram USING fts5(
+            patient_name, content='climes', content_rowid='id', tokenize='trigram'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_climes_trigram_insert AFTER INSERT ON climes
+        WHEN NOT EXISTS (SELECT 1 FROM climes_fts_paused) BEGIN
+            INSERT INTO climes_trigram (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_climes_trigram_delete AFTER DELETE ON climes BEGIN
+            INSERT INTO climes_trigram (climes_trigram, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_climes_trigram_update AFTER UPDATE OF patient_name ON climes BEGIN
+            INSERT INTO climes_trigram (climes_trigram, rowid, patient_name) VALUES ('delete', OLD.id, OLD.patient_name);
+            INSERT INTO climes_trigram (rowid, patient_name) VALUES (NEW.id, NEW.patient_name);
+        END''',
+        "INSERT INTO climes_trigram (climes_trigram) VALUES ('rebuild')",
+    ]
+
+    @staticmethod
+    def tables(cursor):
+        # The full text indexes present in the connected shard
+        cursor.execute("SELECT name FROM sqlite_master WHERE name IN ('climes_fts', 'climes_trigram') ORDER BY name")
+        return [row[0] for row in cursor.fetchall()]
+
+    @staticmethod
+    def configure(shard):
+        # Build the trigram index when fuzzy search is enabled, drop it when it is not
+        with _db.connect(shard) as (cursor, conn):
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                exists = "climes_trigram" in _search.tables(cursor)
+                if _search.fuzzy and not exists:
+                    for statement in _search.trigram_statements:
+                        cursor.execute(statement)
+                    logger.info(Fore.GREEN + "[INFO] Built trigram index in %s", _db.shard_path(shard))
+                elif exists and not _search.fuzzy:
+                    for action in ("insert", "delete", "update"):
+                        cursor.execute(f"DROP TRIGGER IF EXISTS trg_climes_trigram_{action}")
+                    cursor.execute("DROP TABLE climes_trigram")
+                    logger.info(Fore.GREEN + "[INFO] Dropped trigram index from %s", _db.shard_path(shard))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+
+    @staticmethod
+    @contextmanager
+    def paused(cursor):
+        # Inside a write transaction: the index triggers skip the rows inserted
+        # in the block, which appends the (first, last) id ranges it took to
+        # the yielded list. Each range is then indexed in one statement.
+        cursor.execute("INSERT INTO climes_fts_paused (paused) VALUES (1)")
+        ranges = []
+        yield ranges
+        for table in _search.tables(cursor):
+            for first_id, last_id in ranges:
+                cursor.execute(f"INSERT INTO {table} (rowid, patient_name) SELECT id, patient_name FROM climes WHERE id BETWEEN ? AND ?",
+                               (first_id, last_id))
+        cursor.execute("DELETE FROM climes_fts_paused")
+
+
+class _aggregates:
+    # Recomputes the claim_totals aggregate straight from climes
+    recompute_query = '''SELECT status, patient_name, diagnosis_code, procedure_code,
+        SUM(claim_amount) AS total_claim_amount, COUNT(*) AS claim_count
+        FROM climes GROUP BY status, patient_name, diagnosis_code, procedure_code'''
+    # Relative difference between two totals that is still rounding noise
+    tolerance = 1e-9
+
+    @staticmethod
+    def source(aliases, hot=True):
+        # The recompute query over climes, unless `hot` is False, plus the
+        # attached archive partitions
+        if hot and not aliases:
+            return _aggregates.recompute_query
+        columns = "status, patient_name, diagnosis_code, procedure_code, claim_amount"
+        schemas = ["main", *aliases] if hot else aliases
+        union = " UNION ALL ".join(f"SELECT {columns} FROM {schema}.climes" for schema in schemas)
+        return _aggregates.recompute_query.replace("FROM climes", f"FROM ({union})")
+
+    @staticmethod
+    def verify(max_differences=100):
+        # Diff every shard's claim_totals against a fresh recomputation, both
+        # read from the same snapshot. Partitions that do not fit next to the
+        # hot table on one connection are summed in from their own snapshots.
+        # Returns (ok, {"count": n, "differences": [...]})
+        def load(shard):
+            expected = {}
+            with _db.connect(shard) as (cursor, conn):
+                for number, group in enumerate(_archive.groups(conn, _archive.partitions(cursor))):
+                    with _archive.attached(cursor, conn, group) as aliases:
+                        cursor.execute("BEGIN")
+                        cursor.execute(_aggregates.source(aliases, hot=number == 0))
+                        for *key, amount, count in cursor.fetchall():
+                            total = expected.get(tuple(key), (0.0, 0))
+                            expected[tuple(key)] = (total[0] + amount, total[1] + count)
+                        if number == 0:
+                            cursor.execute("SELECT status, patient_name, diagnosis_code, procedure_code, total_claim_amount, claim_count FROM claim_totals")
+                            actual = {row[:4]: row[4:] for row in cursor.fetchall()}
+            return expected, actual
+        differences, count = [], 0
+        for shard, (expected, actual) in enumerate(_db.fan_out(load)):
+            for key in expected.keys() | actual.keys():
+                want, got = expected.get(key, (0.0, 0)), actual.get(key, (0.0, 0))
+                amount_ok = abs(want[0] - got[0]) <= _aggregates.tolerance * max(1.0, abs(want[0]))
+                if amount_ok and want[1] == got[1]:
+                    continue
+                count += 1
+                if len(differences) < max_differences:
+                    differences.append({
+                        "shard": shard, "status": key[0], "patient_name": key[1], "diagnosis_code": key[2], "procedure_code": key[3],
+                        "expected_total": want[0], "actual_total": got[0],
+                        "expected_count": want[1], "actual_count": got[1],
+                    })
+        return count == 0, {"count": count, "differences": differences}
+
+    @staticmethod
+    def rebuild():
+        # Recompute claim_totals from scratch, one transaction per shard.
+        # Partitions that do not fit next to the hot table on one connection
+        # are summed into a temporary table first.
+        def rebuild_shard(shard):
+            with _db.connect(shard) as (cursor, conn):
+                groups = _archive.groups(conn, _archive.partitions(cursor))
+                staged = ""
+                if len(groups) > 1:
+                    cursor.execute('''CREATE TEMP TABLE IF NOT EXISTS archived_totals (status INTEGER, patient_name TEXT,
+                        diagnosis_code INT, procedure_code INT, total_claim_amount REAL, claim_count INTEGER)''')
+                    cursor.execute("DELETE FROM temp.archived_totals")
+                    conn.commit()
+                    for group in groups[1:]:
+                        with _archive.attached(cursor, conn, group) as aliases:
+                            cursor.execute(f"INSERT INTO temp.archived_totals {_aggregates.source(aliases, hot=False)}")
+                    staged = "SELECT * FROM temp.archived_totals UNION ALL "
+                with _archive.attached(cursor, conn, groups[0]) as aliases:
+                    cursor.execute("BEGIN IMMEDIATE")
+                    cursor.execute("DELETE FROM claim_totals")
+                    cursor.execute(f'''INSERT INTO claim_totals (status, patient_name, diagnosis_code, procedure_code, total_claim_amount, claim_count)
+                        SELECT status, patient_name, diagnosis_code, procedure_code, SUM(total_claim_amount), SUM(claim_count)
+                        FROM ({staged}{_aggregates.source(aliases)})
+                        GROUP BY status, patient_name, diagnosis_code, procedure_code''')
+                    rows = cursor.rowcount
+                if staged:
+                    cursor.execute("DROP TABLE temp.archived_totals")
+                return rows
+        rows = sum(_db.fan_out(rebuild_shard))
+        logger.info(Fore.GREEN + "[INFO] Rebuilt claim_totals with %s rows", rows)
+        return rows
+
+
+class _archive:
+    # Hot/cold partitioning of climes. Claims submitted before the horizon are
+    # moved, in small batches, into one SQLite file per submission year and
+    # listed in archive_partitions. Hot queries never touch those files; a
+    # read that may need archived rows ATTACHes only the partitions whose id
+    # range can hold a match. claim_totals keeps counting archived claims, so
+    # reports need no partition at all.
+    directory = os.environ.get('CLAIMS_ARCHIVE_DIR')
+    after_days = int(os.environ.get('CLAIMS_ARCHIVE_AFTER_DAYS', 365))
+    batch_size = int(os.environ.get('CLAIMS_ARCHIVE_BATCH_SIZE', 1000))
+    # Seconds to sleep between batches so other writers get the lock
+    pause = float(os.environ.get('CLAIMS_ARCHIVE_PAUSE', 0.05))
+    columns = "id, patient_name, diagnosis_code, procedure_code, claim_amount, status, submitted_at"
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS {alias}.climes (
+            id INTEGER PRIMARY KEY,
+            patient_name TEXT NOT NULL,
+            diagnosis_code INT NOT NULL,
+            procedure_code INT NOT NULL,
+            claim_amount REAL NOT NULL,
+            status INTEGER NOT NULL,
+            submitted_at TIMESTAMP
+        )''',
+        "CREATE INDEX IF NOT EXISTS {alias}.idx_climes_status_codes ON climes (status, diagnosis_code, procedure_code)",
+        "CREATE INDEX IF NOT EXISTS {alias}.idx_climes_status_id ON climes (status, id)",
+        "CREATE INDEX IF NOT EXISTS {alias}.idx_climes_status_diagnosis_id ON climes (status, diagnosis_code, id)",
+    ]
+    # Add amounts to claim_totals, which spans every partition
+    add_totals = '''INSERT INTO claim_totals (status, patient_name, diagnosis_code, procedure_code, total_claim_amount, claim_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (status, patient_name, diagnosis_code, procedure_code) DO UPDATE SET
+            total_claim_amount = total_claim_amount + excluded.total_claim_amount,
+            claim_count = claim_count + excluded.claim_count'''
+
+    @staticmethod
+    def path(name, shard=0):
+        shard_path = _db.shard_path(shard)
+        directory = _archive.directory or os.path.dirname(os.path.abspath(shard_path))
+        stem = os.path.splitext(os.path.basename(shard_path))[0]
+        return os.path.join(directory, f"{stem}_archive_{name}.db")
+
+    @staticmethod
+    def partitions(cursor, after_id=None, upto_id=None):
+        # Manifest (name, path) rows whose id range overlaps (after_id, upto_id]
+        query = '''SELECT name, path FROM archive_partitions
+            WHERE (? IS NULL OR max_id > ?) AND (? IS NULL OR min_id <= ?) ORDER BY min_id'''
+        cursor.execute(query, (after_id, after_id, upto_id, upto_id))
+        return cursor.fetchall()
+
+    @staticmethod
+    @contextmanager
+    def attached(cursor, conn, partitions, prefix="archive"):
+        # ATTACH the given (name, path) databases for the duration of the
+        # block and yield their schema names. ATTACH and DETACH cannot run
+        # inside a transaction, so one left open by the block is finished first.
+        aliases = []
+        try:
+            for name, path in partitions:
+                alias = f"{prefix}_{name}"
+                cursor.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+                aliases.append(alias)
+            yield aliases
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            for alias in aliases:
+                try:
+                    cursor.execute(f"DETACH DATABASE {alias}")
+                except sqlite3.Error as e:
+                    logger.warning(Fore.YELLOW + "Cannot detach %s - %s", alias, e)
+
+    @staticmethod
+    def groups(conn, partitions):
+        # Split partitions into groups the connection can attach at once next
+        # to the databases it already has attached. SQLite caps attached
+        # databases at 10 and there is one partition per year, so long
+        # histories take several groups. Always returns at least one group.
+        cursor = conn.execute("PRAGMA database_list")
+        in_use = sum(1 for row in cursor.fetchall() if row[1] not in ("main", "temp"))
+        size = max(1, conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) - in_use)
+        return [partitions[start:start + size] for start in range(0, len(partitions), size)] or [[]]
+
+    @staticmethod
+    def find(cursor, conn, claim_id):
+        # Look an id up in the partitions whose range holds it
+        for group in _archive.groups(conn, _archive.partitions(cursor, claim_id - 1, claim_id)):
+            with _archive.attached(cursor, conn, group) as aliases:
+                for alias in aliases:
+                    cursor.execute(f"SELECT * FROM {alias}.climes WHERE id = ?", (claim_id,))
+                    claim = cursor.fetchone()
+                    if claim is not None:
+                        return claim
+        return None
+
+    @staticmethod
+    def spanning(cursor, conn, rows, clauses, params, limit, after_id=None):
+        # Merge the rows matching `clauses` from every partition that can hold
+        # one of the first `limit` ids into the hot `rows`, all ordered by id
+        upto_id = rows[limit - 1][0] if len(rows) >= limit else None
+        partitions = _archive.partitions(cursor, after_id, upto_id)
+        if not partitions:
+            return rows
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        results = [rows]
+        for group in _archive.groups(conn, partitions):
+            with _archive.attached(cursor, conn, group) as aliases:
+                for alias in aliases:
+                    cursor.execute(f"SELECT * FROM {alias}.climes {where} ORDER BY id LIMIT ?", (*params, limit))
+                    results.append(cursor.fetchall())
+        return _db.merge_by_id(results, limit)
+
+    @staticmethod
+    def union(aliases, clauses, params, hot=True):
+        # One query over the hot rows, unless `hot` is False, and the attached
+        # partitions matching `clauses`, for the caller to order and page in
+        # SQL. An archived row whose hot copy is not deleted yet is only read
+        # from the hot table.
+        where = " AND ".join(clauses) or "1"
+        selects = [f"SELECT {_archive.columns} FROM main.climes WHERE {where}"] if hot else []
+        for alias in aliases:
+            selects.append(f'''SELECT {_archive.columns} FROM {alias}.climes AS archived WHERE {where}
+                AND NOT EXISTS (SELECT 1 FROM main.climes AS hot WHERE hot.id = archived.id)''')
+        return " UNION ALL ".join(selects), [*params] * len(selects)
+
+    @staticmethod
+    def modify(cursor, conn, claim_id, status=None, delete=False):
+        # Update the status of, or delete, one archived claim. Returns True
+        # when the claim was found.
+        for group in _archive.groups(conn, _archive.partitions(cursor, claim_id - 1, claim_id)):
+            with _archive.attached(cursor, conn, group) as aliases:
+                cursor.execute("BEGIN IMMEDIATE")
+                if _archive.modify_where(cursor, aliases, "id = ?", [claim_id], status, delete):
+                    return True
         return False
 
-# Call the function to initialize the database
+    @staticmethod
+    def modify_where(cursor, aliases, where, params, status=None, delete=False):
+        # Inside the caller's write transaction, update the status of, or
+        # delete, the archived claims matching `where` in the attached
+        # partitions, and keep claim_totals and claim_versions in step by hand,
+        # their triggers only watch climes. A row whose hot copy is not deleted
+        # yet is left to the hot table. Returns the ids changed.
+        changed_ids, changed = [], set()
+        for alias in aliases:
+            target = f"{where} AND NOT EXISTS (SELECT 1 FROM main.climes AS hot WHERE hot.id = archived.id)"
+            cursor.execute(f'''SELECT status, patient_name, diagnosis_code, procedure_code, SUM(claim_amount), COUNT(*)
+                FROM {alias}.climes AS archived WHERE {target} GROUP BY status, patient_name, diagnosis_code, procedure_code''', params)
+            groups = cursor.fetchall()
+            if not groups:
+                continue
+            if delete:
+                cursor.execute(f"DELETE FROM {alias}.climes AS archived WHERE {target} RETURNING id", params)
+            else:
+                cursor.execute(f"UPDATE {alias}.climes AS archived SET status = ? WHERE {target} RETURNING id", (status, *params))
+            ids = [row[0] for row in cursor.fetchall()]
+            changed_ids.extend(ids)
+            if delete:
+                cursor.execute("UPDATE archive_partitions SET row_count = row_count - ?, updated_at = ? WHERE name = ?",
+                               (len(ids), time.time(), alias[len("archive_"):]))
+            cursor.executemany(_archive.add_totals, [(*group[:4], -amount, -count) for *group, amount, count in groups])
+            cursor.executemany('''DELETE FROM claim_totals WHERE status = ? AND patient_name = ? AND diagnosis_code = ?
+                AND procedure_code = ? AND claim_count <= 0''', [group[:4] for group in groups])
+            if not delete:
+                cursor.executemany(_archive.add_totals, [(status, *group[1:4], amount, count) for *group, amount, count in groups])
+                changed.add(status)
+            changed.update(group[0] for group in groups)
+        cursor.executemany('''INSERT INTO claim_versions (status, version) VALUES (?, 1)
+            ON CONFLICT (status) DO UPDATE SET version = version + 1''', [(value,) for value in changed])
+        return changed_ids
+
+    @staticmethod
+    def cutoff(after_days=None):
+        # submitted_at values older than this are archived, same format as CURRENT_TIMESTAMP
+        days = _archive.after_days if after_days is None else after_days
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - days * 86400))
+
+    @staticmethod
+    def archive_batch(cutoff, batch_size=None, shard=0):
+        # Move one batch of the shard's oldest claims submitted before
+        # `cutoff`, all from the same year, into that year's partition of the
+        # shard. Returns the number of claims moved, 0 once nothing is left.
+        batch_size = batch_size or _archive.batch_size
+        with _db.connect(shard) as (cursor, conn):
+            cursor.execute("SELECT strftime('%Y', submitted_at) FROM climes WHERE submitted_at < ? ORDER BY submitted_at LIMIT 1",
+                           (cutoff,))
+            row = cursor.fetchone()
+            if row is None or row[0] is None:
+                return 0
+            name = row[0]
+            boundary = min(cutoff, f"{int(name) + 1:04d}-01-01 00:00:00")
+            cursor.execute("SELECT id FROM climes WHERE submitted_at < ? ORDER BY submitted_at LIMIT ?", (boundary, batch_size))
+            ids = json.dumps([row[0] for row in cursor.fetchall()])
+            path = _archive.path(name, shard)
+            with _archive.attached(cursor, conn, [(name, path)]) as (alias,):
+                cursor.execute(f"PRAGMA {alias}.journal_mode = WAL")
+                for statement in _archive.schema:
+                    cursor.execute(statement.format(alias=alias))
+                # 1. Copy the batch into the archive. Only the archive file is
+                #    written, hot writers carry on meanwhile.
+                cursor.execute("BEGIN")
+                cursor.execute(f'''INSERT OR REPLACE INTO {alias}.climes ({_archive.columns})
+                    SELECT {_archive.columns} FROM main.climes WHERE id IN (SELECT value FROM json_each(?))''', (ids,))
+                conn.commit()
+                # 2. Under a short write lock, delete the hot rows whose archived
+                #    copy is identical and put their amounts back into
+                #    claim_totals. A row changed in between stays hot and is
+                #    copied again later. The archive commits first, so a crash
+                #    can leave a row in both places but never in neither.
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute(f'''DELETE FROM main.climes WHERE id IN (SELECT value FROM json_each(?))
+                    AND EXISTS (SELECT 1 FROM {alias}.climes AS a WHERE a.id = climes.id AND a.status = climes.status
+                        AND a.patient_name = climes.patient_name AND a.diagnosis_code = climes.diagnosis_code
+                        AND a.procedure_code = climes.procedure_code AND a.claim_amount = climes.claim_amount)
+                    RETURNING status, patient_name, diagnosis_code, procedure_code, claim_amount, id, submitted_at''', (ids,))
+                moved = cursor.fetchall()
+                if moved:
+                    cursor.executemany(_archive.add_totals, [row[:5] + (1,) for row in moved])
+                    cursor.execute('''INSERT INTO archive_partitions (name, path, min_id, max_id, min_submitted_at,
+                            max_submitted_at, row_count, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (name) DO UPDATE SET
+                            min_id = MIN(min_id, excluded.min_id), max_id = MAX(max_id, excluded.max_id),
+                            min_submitted_at = MIN(min_submitted_at, excluded.min_submitted_at),
+                            max_submitted_at = MAX(max_submitted_at, excluded.max_submitted_at),
+                            row_count = row_count + excluded.row_count, updated_at = excluded.updated_at''',
+                        (name, path, min(row[5] for row in moved), max(row[5] for row in moved),
+                         min(row[6] for row in moved), max(row[6] for row in moved), len(moved), time.time(), time.time()))
+        logger.debug(Fore.GREEN + "Archived %s claims into partition %s", len(moved), name)
+        return len(moved)
+
+    @staticmethod
+    def run(after_days=None, batch_size=None, max_batches=None, pause=None):
+        # Archive batch after batch until nothing older than the horizon is
+        # left, sleeping between batches. Returns a summary of the run.
+        cutoff = _archive.cutoff(after_days)
+        pause = _archive.pause if pause is None else pause
+        archived, batches = 0, 0
+        for shard in range(_db.shards):
+            while max_batches is None or batches < max_batches:
+                moved = _archive.archive_batch(cutoff, batch_size, shard)
+                if not moved:
+                    break
+                archived += moved
+                batches += 1
+                time.sleep(pause)
+        if archived:
+            logger.info(Fore.GREEN + "[INFO] Archived %s claims submitted before %s in %s batches", archived, cutoff, batches)
+        return {"cutoff": cutoff, "archived": archived, "batches": batches, "partitions": _archive.manifest()}
+
+    @staticmethod
+    def manifest():
+        def partitions(shard):
+            with _db.connect(shard) as (cursor, conn):
+                cursor.execute("SELECT * FROM archive_partitions ORDER BY min_id")
+                return [{"shard": shard, **dict(zip((column[0] for column in cursor.description), row))} for row in cursor.fetchall()]
+        return [partition for partitions in _db.fan_out(partitions) for partition in partitions]
+
+
+class _shards:
+    # Moves hot claims to the shard their id routes to, after CLAIMS_DB_SHARDS
+    # changes. Each batch is copied under a short write lock on both files
+    # and only then deleted from its old shard, so a crash can leave a claim
+    # in two shards but never in none; the copy in the shard it routes to is
+    # the one reads and writes see. Archive partitions stay with their shard.
+    batch_size = int(os.environ.get('CLAIMS_SHARD_BATCH_SIZE', 1000))
+    # Seconds to sleep between batches so other writers get the lock
+    pause = float(os.environ.get('CLAIMS_SHARD_PAUSE', 0.05))
+
+    @staticmethod
+    def move_batch(source, after_id, batch_size):
+        # Move the next claims of `source` after `after_id` that belong to
+        # another shard. Returns (moved, last id looked at), or None when done.
+        with _db.connect(source) as (cursor, conn):
+            cursor.execute("SELECT id FROM climes WHERE id > ? AND id % ? != ? ORDER BY id LIMIT ?",
+                           (after_id, _db.shards, source, batch_size))
+            ids = [row[0] for row in cursor.fetchall()]
+            if not ids:
+                return None
+            targets = {}
+            for claim_id in ids:
+                targets.setdefault(_db.shard_for_id(claim_id), []).append(claim_id)
+            moved = 0
+            for target, target_ids in targets.items():
+                batch = json.dumps(target_ids)
+                with _archive.attached(cursor, conn, [(target, _db.shard_path(target))], prefix="shard") as (alias,):
+                    # The target's own triggers keep its claim_totals and
+                    # claim_versions in step, as the source's do on delete
+                    cursor.execute("BEGIN IMMEDIATE")
+                    cursor.execute(f'''INSERT OR IGNORE INTO {alias}.climes ({_archive.columns})
+                        SELECT {_archive.columns} FROM main.climes WHERE id IN (SELECT value FROM json_each(?))''', (batch,))
+                    conn.commit()
+                    cursor.execute("BEGIN IMMEDIATE")
+                    cursor.execute(f'''DELETE FROM main.climes WHERE id IN (SELECT value FROM json_each(?))
+                        AND EXISTS (SELECT 1 FROM {alias}.climes AS t WHERE t.id = climes.id)''', (batch,))
+                    moved += cursor.rowcount
+        logger.debug(Fore.GREEN + "Moved %s claims out of shard %s", moved, source)
+        return moved, ids[-1]
+
+    @staticmethod
+    def rebalance(batch_size=None, pause=None):
+        # Walk every shard file, configured or left over, and move misplaced
+        # claims batch by batch. Returns the claims moved per source shard and
+        # the resulting layout.
+        batch_size = batch_size or _shards.batch_size
+        pause = _shards.pause if pause is None else pause
+        moved = {}
+        for source in _db.existing_shards():
+            _migrations.apply_shard(source)
+            after_id = 0
+            while True:
+                result = _shards.move_batch(source, after_id, batch_size)
+                if result is None:
+                    break
+                count, after_id = result
+                moved[source] = moved.get(source, 0) + count
+                time.sleep(pause)
+        _db.align_sequences()
+        if moved:
+            logger.info(Fore.GREEN + "[INFO] Rebalanced %s claims across %s shards", sum(moved.values()), _db.shards)
+        return {"shards": _db.shards, "moved": moved, "layout": _shards.layout()}
+
+    @staticmethod
+    def layout():
+        def describe(shard):
+            with _db.connect(shard) as (cursor, conn):
+                cursor.execute(f"SELECT COUNT(*), {_db_query.shard_sequence} FROM climes")
+                claims, sequence = cursor.fetchone()
+            return {"shard": shard, "path": _db.shard_path(shard), "claims": claims, "sequence": sequence}
+        return _db.fan_out(describe, _db.existing_shards())
+
+
+def _init__db():
+    try:
+        applied = _migrations.apply()
+        if applied:
+            logger.info(Fore.GREEN + "[INFO] Database successfully initialized.")
+        return bool(applied)
+    except sqlite3.Error as e:
+        logger.error(Fore.RED + "An error occurred during database initialization: %s", e)
+        return f"An error occurred: {e}"
+
+# Initialize the database, called by the app factory and the maintenance commands
 def __main__():
     result = _init__db()
     return result
-
-__main__()
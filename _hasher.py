@@ -0,0 +1,86 @@
+import os
+import hmac
+import hashlib
+import threading
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _hasher:
+    # PBKDF2-HMAC-SHA256 password hashing. hashlib releases the GIL while it
+    # hashes, so a small thread pool keeps request threads responsive while
+    # bounding how many hashes run at once.
+    algorithm = 'pbkdf2_sha256'
+    iterations = int(os.environ.get('CLAIMS_PASSWORD_ITERATIONS', 310000))
+    salt_bytes = 16
+    workers = int(os.environ.get('CLAIMS_HASHER_WORKERS', 4))
+    # Hashes allowed to wait for a worker before callers are turned away
+    max_pending = int(os.environ.get('CLAIMS_HASHER_MAX_PENDING', 64))
+    timeout = float(os.environ.get('CLAIMS_HASHER_TIMEOUT', 10))
+    _executor = None
+    _slots = None
+    _lock = threading.Lock()
+
+    class Busy(RuntimeError):
+        pass
+
+    @staticmethod
+    def _hash_sync(password, salt, iterations):
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+        return f"{_hasher.algorithm}${iterations}${salt.hex()}${digest.hex()}"
+
+    @staticmethod
+    def _verify_sync(password, encoded):
+        # Return (matches, needs_rehash). Values without the algorithm prefix
+        # are legacy plaintext passwords and always need rehashing.
+        parts = encoded.split('$')
+        if len(parts) != 4 or parts[0] != _hasher.algorithm:
+            return hmac.compare_digest(password.encode(), encoded.encode()), True
+        iterations, salt = int(parts[1]), bytes.fromhex(parts[2])
+        matches = hmac.compare_digest(_hasher._hash_sync(password, salt, iterations), encoded)
+        return matches, iterations != _hasher.iterations
+
+    @staticmethod
+    def _run(fn, *args):
+        if _hasher._executor is None:
+            with _hasher._lock:
+                if _hasher._executor is None:
+                    _hasher._slots = threading.BoundedSemaphore(_hasher.workers + _hasher.max_pending)
+                    _hasher._executor = ThreadPoolExecutor(max_workers=_hasher.workers, thread_name_prefix="hasher")
+        slots = _hasher._slots
+        if not slots.acquire(timeout=_hasher.timeout):
+            raise _hasher.Busy("password hasher is overloaded")
+        # The slot is held until the hash is done, not until the caller stops
+        # waiting, so abandoned hashes still count against the queue
+        try:
+            future = _hasher._executor.submit(fn, *args)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(timeout=_hasher.timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            raise _hasher.Busy("password hasher timed out")
+
+    @staticmethod
+    def hash(password):
+        return _hasher._run(_hasher._hash_sync, password, os.urandom(_hasher.salt_bytes), _hasher.iterations)
+
+    @staticmethod
+    def verify(password, encoded):
+        return _hasher._run(_hasher._verify_sync, password, encoded)
+
+    @staticmethod
+    def dummy():
+        # A well formed hash no password matches, verified in place of a
+        # missing user's so unknown emails take as long as wrong passwords
+        return f"{_hasher.algorithm}${_hasher.iterations}${'00' * _hasher.salt_bytes}${'0' * 64}"
+
+    @staticmethod
+    def shutdown(wait=True):
+        with _hasher._lock:
+            executor, _hasher._executor = _hasher._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
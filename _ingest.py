@@ -0,0 +1,169 @@
+import codecs
+import csv
+import json
+import os
+from _db_helper import _db_query
+from _schema import _schema, _schemas
+
+
+class _ingest:
+    # Columns every ingested claim must provide, in insert order
+    fields = _schemas.claim.names
+    # Rows per transaction unless the caller asks otherwise
+    batch_size = int(os.environ.get('CLAIMS_BULK_BATCH_SIZE', 5000))
+    max_batch_size = 50000
+    # Stop collecting row errors past this many, only the count keeps growing
+    max_errors = 1000
+    chunk_size = 64 * 1024
+    # Longest JSON array element, in characters, read ahead before giving up
+    # on decoding it, so a bad element never pulls the rest of the body in
+    max_element_size = int(os.environ.get('CLAIMS_BULK_MAX_ELEMENT_SIZE', 4 * chunk_size))
+
+    class ParseError(ValueError):
+        pass
+
+    @staticmethod
+    def iter_json_array(stream):
+        # Incrementally decode a top level JSON array, holding at most one
+        # chunk plus the element being decoded in memory
+        reader = codecs.getreader('utf-8')(stream)
+        decoder = json.JSONDecoder()
+        buffer, pos, eof = "", 0, False
+
+        def fill():
+            nonlocal buffer, pos, eof
+            chunk = reader.read(_ingest.chunk_size)
+            if not chunk:
+                eof = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def skip(separators):
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in separators:
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                fill()
+
+        skip(" \t\r\n")
+        if pos >= len(buffer) or buffer[pos] != "[":
+            raise _ingest.ParseError("body must be a JSON array")
+        pos += 1
+        expect_value, empty = True, True
+        while True:
+            skip(" \t\r\n")
+            if pos >= len(buffer):
+                raise _ingest.ParseError("unterminated JSON array")
+            if buffer[pos] == "]":
+                if expect_value and not empty:
+                    raise _ingest.ParseError(f"expected a value after ',' at offset {pos}")
+                return
+            if not expect_value:
+                if buffer[pos] != ",":
+                    raise _ingest.ParseError(f"expected ',' or ']' at offset {pos}")
+                pos += 1
+                expect_value = True
+                continue
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    if eof or not isinstance(value, (int, float)) or isinstance(value, bool):
+                        break
+                    # A number whose trailing digits, '.', exponent or sign run
+                    # to the end of the buffer may continue in the next chunk
+                    tail = end
+                    while tail < len(buffer) and buffer[tail] in ".eE+-0123456789":
+                        tail += 1
+                    if tail < len(buffer):
+                        break
+                except json.JSONDecodeError as e:
+                    if eof:
+                        raise _ingest.ParseError(f"invalid JSON: {e.msg}")
+                    error = e.msg
+                else:
+                    error = "number does not end"
+                if len(buffer) - pos > _ingest.max_element_size:
+                    raise _ingest.ParseError(f"invalid JSON: {error} within {_ingest.max_element_size} characters")
+                fill()
+            pos = end
+            expect_value, empty = False, False
+            yield value
+
+    @staticmethod
+    def iter_ndjson(stream):
+        # One JSON object per line, blank lines are ignored
+        for line_number, line in enumerate(codecs.getreader('utf-8')(stream), start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                yield _ingest.ParseError(f"line {line_number}: invalid JSON: {e.msg}")
+
+    @staticmethod
+    def iter_csv(stream):
+        # CSV with a header row naming the claim fields
+        yield from csv.DictReader(codecs.getreader('utf-8-sig')(stream))
+
+    @staticmethod
+    def iter_rows(stream, content_type):
+        content_type = (content_type or "").split(";")[0].strip().lower()
+        if content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines"):
+            return _ingest.iter_ndjson(stream)
+        if content_type in ("text/csv", "application/csv"):
+            return _ingest.iter_csv(stream)
+        if content_type == "application/json":
+            return _ingest.iter_json_array(stream)
+        raise _ingest.ParseError(f"unsupported content type: {content_type or 'missing'}")
+
+    @staticmethod
+    def ingest(rows, batch_size=None):
+        # Validate rows as they stream in and insert them batch by batch, one
+        # transaction per batch
+        batch_size = batch_size or _ingest.batch_size
+        summary = {"received": 0, "inserted": 0, "rejected": 0, "inserted_id_ranges": [], "errors": []}
+        batch, batch_rows = [], []
+
+        def reject(row_number, message, fields=None):
+            summary["rejected"] += 1
+            if len(summary["errors"]) < _ingest.max_errors:
+                error = {"row": row_number, "error": message}
+                if fields:
+                    error["fields"] = fields
+                summary["errors"].append(error)
+
+        def flush():
+            # Validate the whole batch column by column, then insert the valid rows
+            indexes, values, errors = _schemas.claim.validate_batch(batch)
+            for index, field_errors in errors:
+                reject(batch_rows[index], _schema.message(field_errors), field_errors)
+            if values:
+                # Shards commit independently, only the rows of a shard that failed are rejected
+                ok, ranges, failed = _db_query.add_claims_batch(values)
+                summary["inserted"] += len(values) - len(failed)
+                summary["inserted_id_ranges"].extend(list(id_range) for id_range in ranges)
+                for position, message in failed.items():
+                    reject(batch_rows[indexes[position]], message)
+            batch.clear()
+            batch_rows.clear()
+
+        try:
+            for row_number, row in enumerate(rows, start=1):
+                summary["received"] += 1
+                if isinstance(row, Exception):
+                    reject(row_number, str(row))
+                    continue
+                batch.append(row)
+                batch_rows.append(row_number)
+                if len(batch) >= batch_size:
+                    flush()
+        except (_ingest.ParseError, UnicodeDecodeError, csv.Error) as e:
+            if batch:
+                flush()
+            summary["parse_error"] = str(e)
+            return False, summary
+        if batch:
+            flush()
+        return True, summary
@@ -0,0 +1,45 @@
+import os
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
+from colorama import init
+
+
+class _log:
+    # Log records are put on an in-memory queue by the request threads and
+    # written to stderr by a single background listener thread
+    format = '%(asctime)s - %(levelname)s - %(message)s'
+    level = os.environ.get('CLAIMS_LOG_LEVEL', 'INFO')
+    # Per-query messages from the database layer are logged at DEBUG, unset
+    # means the database logger follows the overall level
+    db_level = os.environ.get('CLAIMS_DB_LOG_LEVEL', 'NOTSET')
+    _listener = None
+
+    @staticmethod
+    def configure(level=None, db_level=None):
+        # Safe to call more than once, only the levels change after the first call
+        root = logging.getLogger()
+        root.setLevel((level or _log.level).upper())
+        logging.getLogger("claims.db").setLevel((db_level or _log.db_level).upper())
+        if _log._listener is not None:
+            return
+        # Initialize colorama
+        init(autoreset=True)
+        records = queue.SimpleQueue()
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter(_log.format))
+        _log._listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+        _log._listener.start()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(logging.handlers.QueueHandler(records))
+        atexit.register(_log.stop)
+
+    @staticmethod
+    def stop():
+        # Flush whatever is still queued
+        listener, _log._listener = _log._listener, None
+        if listener is not None:
+            listener.stop()
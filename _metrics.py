@@ -0,0 +1,187 @@
+import re
+import time
+import bisect
+import threading
+from functools import lru_cache
+
+
+class _histogram:
+    # Cumulative-bucket latency histogram, one series per label tuple
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(series):
+            label_text = _metrics.format_labels(self.labels, labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = f'{label_text[:-1]},le="{le}"}}' if label_text else f'{{le="{le}"}}'
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class _counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_metrics.format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class _timed_cursor:
+    # Wraps a sqlite3 cursor to time every statement and count the rows it
+    # returned or changed. Anything not wrapped is passed straight through.
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._labels = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            _metrics.sql_rows.inc(1, *self._labels)
+            yield row
+
+    def _timed(self, method, sql, *args):
+        self._labels = _metrics.statement_labels(sql)
+        started = time.perf_counter()
+        try:
+            method(sql, *args)
+        finally:
+            _metrics.sql_latency.observe(time.perf_counter() - started, *self._labels)
+        if self._cursor.rowcount > 0:
+            _metrics.sql_rows.inc(self._cursor.rowcount, *self._labels)
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._timed(self._cursor.execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(self._cursor.executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self._timed(self._cursor.executescript, sql_script)
+
+    def _fetched(self, rows):
+        if rows and self._labels is not None:
+            _metrics.sql_rows.inc(len(rows), *self._labels)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None and self._labels is not None:
+            _metrics.sql_rows.inc(1, *self._labels)
+        return row
+
+    def fetchmany(self, size=None):
+        return self._fetched(self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany())
+
+    def fetchall(self):
+        return self._fetched(self._cursor.fetchall())
+
+
+class _metrics:
+    # Bucket bounds in seconds shared by every latency histogram
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    http_latency = _histogram("claims_http_request_duration_seconds", "HTTP request latency by route",
+                              ("method", "route", "status"), buckets)
+    sql_latency = _histogram("claims_sql_statement_duration_seconds", "SQL statement execution latency",
+                             ("operation", "table"), buckets)
+    sql_rows = _counter("claims_sql_rows_total", "Rows returned or changed by SQL statements", ("operation", "table"))
+    # Callables returning [(name, type, help, [(labels dict, value)])] evaluated on every scrape
+    collectors = []
+    _statement = re.compile(r"^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+NOT\s+EXISTS\s+)?([\w.]+))?", re.IGNORECASE | re.DOTALL)
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def statement_labels(sql):
+        # ("select", "climes") style labels, cached per distinct SQL string
+        match = _metrics._statement.match(sql)
+        if match is None:
+            return ("other", "")
+        operation, table = match.group(1).lower(), (match.group(2) or "").lower()
+        if operation == "update":
+            table = sql.split(None, 2)[1].lower()
+        return (operation, table)
+
+    @staticmethod
+    def format_labels(names, values):
+        if not names:
+            return ""
+        pairs = ",".join(f'{name}="{_metrics.escape(value)}"' for name, value in zip(names, values))
+        return "{" + pairs + "}"
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    @staticmethod
+    def register(collector):
+        _metrics.collectors.append(collector)
+
+    @staticmethod
+    def install(app):
+        # Record the latency of every request against its route template
+        from flask import g, request
+
+        @app.before_request
+        def start_timer():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def record_latency(response):
+            started = g.pop("metrics_started", None)
+            if started is not None:
+                route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+                _metrics.http_latency.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+            return response
+
+    @staticmethod
+    def render():
+        # Prometheus text exposition format
+        lines = []
+        for metric in (_metrics.http_latency, _metrics.sql_latency, _metrics.sql_rows):
+            lines.extend(metric.render())
+        for collector in _metrics.collectors:
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_metrics.format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,331 @@
+import csv
+import io
+import os
+import gzip
+import json
+import time
+import uuid
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from colorama import Fore
+from _db_helper import _db, _db_query
+from _log import _log
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("claims.reports")
+
+
+class _reports:
+    header = ['Patient Name', 'Diagnosis Code', 'Procedure Code', 'Status', 'Total Claim Amount']
+    # Keys of each NDJSON record, in the same order as the CSV columns
+    fields = ('patient_name', 'diagnosis_code', 'procedure_code', 'status', 'total_claim_amount')
+    # Output format -> (mimetype, file extension)
+    formats = {'csv': ('text/csv', 'csv'), 'ndjson': ('application/x-ndjson', 'ndjson')}
+    # Content-Encoding -> file suffix of the pre-compressed copies written next
+    # to every report, in order of preference. zstd needs the zstandard package.
+    suffixes = {'zstd': '.zst', 'gzip': '.gz'}
+    encodings = tuple(encoding for encoding in os.environ.get('CLAIMS_REPORT_ENCODINGS', 'zstd,gzip').split(',')
+                      if encoding == 'gzip' or (encoding == 'zstd' and zstandard is not None))
+    gzip_level = int(os.environ.get('CLAIMS_REPORT_GZIP_LEVEL', 6))
+    zstd_level = int(os.environ.get('CLAIMS_REPORT_ZSTD_LEVEL', 3))
+    # Finished reports live here, resolved once so every worker agrees on it
+    directory = os.path.abspath(os.environ.get('CLAIMS_REPORT_DIR', 'reports'))
+    # Artifacts are evicted, least recently used first, once they are older
+    # than max_age seconds or together take more than max_bytes
+    max_bytes = int(os.environ.get('CLAIMS_REPORT_MAX_BYTES', 1024 ** 3))
+    max_age = int(os.environ.get('CLAIMS_REPORT_MAX_AGE', 86400))
+    # Seconds between eviction passes triggered by new jobs
+    evict_interval = int(os.environ.get('CLAIMS_REPORT_EVICT_INTERVAL', 60))
+    _last_eviction = 0.0
+    _stats = {"requests": 0, "hits": 0, "joined": 0, "misses": 0, "evicted_reports": 0, "evicted_files": 0, "bytes_reclaimed": 0}
+    _stats_lock = threading.Lock()
+    # "celery" hands jobs to a Celery worker, "process" to a local process pool
+    # that needs no broker and "thread" runs them in this process
+    backend = os.environ.get('CLAIMS_REPORT_BACKEND', 'celery' if os.environ.get('CELERY_BROKER_URL') else 'process')
+    workers = int(os.environ.get('CLAIMS_REPORT_WORKERS', 2))
+    # Seconds between progress writes while a job is running
+    progress_interval = 0.5
+    # A queued job no worker picked up, or a running job whose heartbeat is
+    # older than this, is reported as failed
+    stale_after = int(os.environ.get('CLAIMS_REPORT_STALE_AFTER', 300))
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    @staticmethod
+    def report_path(job_id, format='csv', encoding=None):
+        suffix = _reports.suffixes[encoding] if encoding else ""
+        return os.path.join(_reports.directory, f"{job_id}_claims_report.{_reports.formats[format][1]}{suffix}")
+
+    @staticmethod
+    def available_encodings(job_id, format='csv'):
+        # Pre-compressed copies that exist on disk for a finished report
+        return [encoding for encoding in _reports.suffixes
+                if os.path.exists(_reports.report_path(job_id, format, encoding))]
+
+    @staticmethod
+    def iter_csv(status, chunk_size=1000):
+        # Yield the report as CSV text, one (row count, text) pair per fetchmany() chunk
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(_reports.header)
+        for chunk in _db_query.iter_claim_data_report(status, chunk_size):
+            writer.writerows(chunk)
+            yield len(chunk), buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield 0, buffer.getvalue()
+
+    @staticmethod
+    def iter_ndjson(status, chunk_size=1000):
+        # Same rows as iter_csv(), one JSON object per line
+        fields = _reports.fields
+        for chunk in _db_query.iter_claim_data_report(status, chunk_size):
+            yield len(chunk), "".join(json.dumps(dict(zip(fields, row)), separators=(",", ":")) + "\n" for row in chunk)
+
+    @staticmethod
+    def iter_rows(status, format='csv', chunk_size=1000):
+        if format == 'ndjson':
+            return _reports.iter_ndjson(status, chunk_size)
+        return _reports.iter_csv(status, chunk_size)
+
+    @staticmethod
+    def open_outputs(job_id, format):
+        # The plain report plus one compressed copy per enabled encoding, all
+        # written from the same pass over the rows. Returns [(path, file, raw)]
+        # where raw is the underlying file to close after the compressor.
+        outputs = []
+        plain = open(_reports.report_path(job_id, format) + ".part", 'wb')
+        outputs.append((_reports.report_path(job_id, format), plain, None))
+        for encoding in _reports.encodings:
+            path = _reports.report_path(job_id, format, encoding)
+            raw = open(path + ".part", 'wb')
+            if encoding == 'gzip':
+                # mtime=0 keeps the bytes, and so the ETag, reproducible
+                compressed = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=_reports.gzip_level, mtime=0)
+            else:
+                compressed = zstandard.ZstdCompressor(level=_reports.zstd_level).stream_writer(raw, closefd=False)
+            outputs.append((path, compressed, raw))
+        return outputs
+
+    @staticmethod
+    def create(status, format='csv'):
+        # Return (True, (job id, outcome)). A completed report for the same
+        # status, format and data version is a "hit" and a queued or running one
+        # is "joined"; otherwise a new job is recorded ("miss") and the caller
+        # submits it.
+        for attempt in range(2):
+            stale_before = time.time() - _reports.stale_after
+            ok, result = _db_query.find_or_create_report_job(str(uuid.uuid4()), status, format, stale_before)
+            if not ok:
+                return False, result
+            job, created = result
+            # A cached report whose files have gone is expired and generated again
+            if job["state"] == 'completed' and not os.path.exists(job["path"] or ""):
+                _db_query.expire_report_job(job["id"])
+                continue
+            break
+        outcome = "miss" if created else "hit" if job["state"] == 'completed' else "joined"
+        counter = {"miss": "misses", "hit": "hits", "joined": "joined"}[outcome]
+        _reports.count(requests=1, **{counter: 1})
+        if created:
+            _reports.maybe_evict()
+        return True, (job["id"], outcome)
+
+    @staticmethod
+    def count(**amounts):
+        with _reports._stats_lock:
+            for name, amount in amounts.items():
+                _reports._stats[name] += amount
+
+    @staticmethod
+    def stats():
+        with _reports._stats_lock:
+            stats = dict(_reports._stats)
+        stats["hit_rate"] = round((stats["hits"] + stats["joined"]) / stats["requests"], 4) if stats["requests"] else 0.0
+        stats.update(max_bytes=_reports.max_bytes, max_age=_reports.max_age)
+        return stats
+
+    @staticmethod
+    def artifact_paths(job):
+        # Every file a job may have written: the recorded path and the copies next to it
+        paths = {job["path"]} if job.get("path") else set()
+        paths.add(_reports.report_path(job["id"], job["format"]))
+        paths.update(_reports.report_path(job["id"], job["format"], encoding) for encoding in _reports.suffixes)
+        return paths
+
+    @staticmethod
+    def maybe_evict():
+        # Evict at most once per evict_interval, on whichever request gets here first
+        with _reports._stats_lock:
+            now = time.monotonic()
+            if now - _reports._last_eviction < _reports.evict_interval:
+                return None
+            _reports._last_eviction = now
+        return _reports.evict()
+
+    @staticmethod
+    def evict(now=None):
+        # Expire completed reports past max_age, then the least recently used
+        # ones until the rest fit in max_bytes, and remove stray files from the
+        # report directory. Returns what was reclaimed.
+        now = now or time.time()
+        ok, jobs = _db_query.get_completed_report_jobs()
+        if not ok:
+            return {"evicted_reports": 0, "evicted_files": 0, "bytes_reclaimed": 0}
+        kept, kept_bytes, expired = set(), 0, []
+        for job in jobs:
+            size = job["bytes"]
+            if size is None:
+                size = sum(os.path.getsize(path) for path in _reports.artifact_paths(job) if os.path.exists(path))
+            if now - (job["finished_at"] or 0) > _reports.max_age or kept_bytes + size > _reports.max_bytes:
+                expired.append(job)
+            else:
+                kept.add(job["id"])
+                kept_bytes += size
+        reclaimed = {"evicted_reports": 0, "evicted_files": 0, "bytes_reclaimed": 0}
+
+        def remove(path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                return
+            reclaimed["evicted_files"] += 1
+            reclaimed["bytes_reclaimed"] += size
+
+        for job in expired:
+            # Only the process that flips the job to expired deletes its files
+            if _db_query.expire_report_job(job["id"]) == (True, True):
+                reclaimed["evicted_reports"] += 1
+                for path in _reports.artifact_paths(job):
+                    remove(path)
+        # Files no completed job owns: leftovers of failed or crashed jobs
+        if os.path.isdir(_reports.directory):
+            for entry in os.scandir(_reports.directory):
+                job_id = entry.name.split("_claims_report", 1)[0]
+                if job_id in kept or not entry.is_file():
+                    continue
+                limit = _reports.stale_after if entry.name.endswith(".part") else _reports.max_age
+                if now - entry.stat().st_mtime > limit:
+                    remove(entry.path)
+        _reports.count(**reclaimed)
+        if reclaimed["evicted_files"]:
+            logger.info(Fore.GREEN + "Evicted %s report files, %s bytes reclaimed",
+                        reclaimed["evicted_files"], reclaimed["bytes_reclaimed"])
+        return reclaimed
+
+    @staticmethod
+    def run(job_id, db_path=None):
+        # Generate the report for a job, recording progress, timing and failures
+        # in report_jobs. Runs inside whichever worker picked the job up.
+        if db_path and db_path != _db.path:
+            _db.configure(path=db_path)
+        found, job = _db_query.get_report_job(job_id)
+        if not found:
+            logger.error(Fore.RED + "Report job %s cannot be loaded - %s", job_id, job)
+            return job_id
+        outputs = []
+        try:
+            count = _db_query.count_claim_data_report(job["status"])
+            _db_query.update_report_job(job_id, state='in progress', started_at=time.time(),
+                                        total_rows=count[1] if count[0] else None)
+            rows_written, last_report = 0, time.monotonic()
+            os.makedirs(_reports.directory, exist_ok=True)
+            # Write to temporary names so a download never sees a partial file
+            outputs = _reports.open_outputs(job_id, job["format"])
+            for rows, text in _reports.iter_rows(job["status"], job["format"]):
+                data = text.encode()
+                for path, output, raw in outputs:
+                    output.write(data)
+                rows_written += rows
+                if time.monotonic() - last_report >= _reports.progress_interval:
+                    _db_query.update_report_job(job_id, rows_written=rows_written)
+                    last_report = time.monotonic()
+            _reports.close_outputs(outputs)
+            # The plain file goes last, it is what marks the report as present
+            for path, output, raw in reversed(outputs):
+                os.replace(path + ".part", path)
+            _db_query.update_report_job(job_id, state='completed', rows_written=rows_written, path=outputs[0][0],
+                                        bytes=sum(os.path.getsize(path) for path, output, raw in outputs),
+                                        finished_at=time.time())
+            logger.info(Fore.GREEN + "Report job %s completed with %s rows", job_id, rows_written)
+        except Exception as e:
+            logger.error(Fore.RED + "Report job %s failed - %s", job_id, e)
+            _db_query.update_report_job(job_id, state='failed', error=str(e), finished_at=time.time())
+            _reports.close_outputs(outputs)
+            for path, output, raw in outputs:
+                if os.path.exists(path + ".part"):
+                    os.remove(path + ".part")
+        return job_id
+
+    @staticmethod
+    def close_outputs(outputs):
+        # Flush the compressors before the files underneath them
+        for path, output, raw in outputs:
+            if not output.closed:
+                output.close()
+            if raw is not None and not raw.closed:
+                raw.close()
+
+    @staticmethod
+    def executor():
+        if _reports._executor is None:
+            with _reports._executor_lock:
+                if _reports._executor is None:
+                    if _reports.backend == 'thread':
+                        _reports._executor = ThreadPoolExecutor(max_workers=_reports.workers, thread_name_prefix="report")
+                    else:
+                        # Spawned workers start clean instead of inheriting the
+                        # request threads and open connections of this process
+                        _reports._executor = ProcessPoolExecutor(max_workers=_reports.workers,
+                                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                                 initializer=_log.configure)
+        return _reports._executor
+
+    @staticmethod
+    def submit(job_id):
+        # Hand a job to the local worker pool, marking it failed if the worker dies
+        def on_done(future):
+            if future.exception() is not None:
+                _db_query.update_report_job(job_id, state='failed', error=f"worker crashed: {future.exception()}",
+                                            finished_at=time.time())
+                with _reports._executor_lock:
+                    _reports._executor = None
+        future = _reports.executor().submit(_reports.run, job_id, _db.path)
+        future.add_done_callback(on_done)
+        return future
+
+    @staticmethod
+    def shutdown(wait=True):
+        with _reports._executor_lock:
+            executor, _reports._executor = _reports._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    @staticmethod
+    def status(job_id):
+        # Return (found, job) with progress and durations filled in
+        found, job = _db_query.get_report_job(job_id)
+        if not found:
+            return False, job
+        now = time.time()
+        if job["state"] in ('queued', 'in progress') and now - (job["updated_at"] or job["created_at"]) > _reports.stale_after:
+            job["error"] = "no worker picked the job up" if job["state"] == 'queued' else "worker stopped responding"
+            job["state"], job["finished_at"] = 'failed', now
+            _db_query.update_report_job(job_id, state=job["state"], error=job["error"], finished_at=now)
+        total = job["total_rows"]
+        if job["state"] == 'completed':
+            job["progress"] = 1.0
+        else:
+            job["progress"] = round(min(job["rows_written"] / total, 1.0), 4) if total else 0.0
+        started, finished = job["started_at"], job["finished_at"]
+        job["queued_seconds"] = round((started or finished or now) - job["created_at"], 3)
+        job["run_seconds"] = round((finished or now) - started, 3) if started else None
+        return True, job
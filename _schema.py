@@ -0,0 +1,239 @@
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class _field:
+    # One declared payload field. `kind` is "string", "email", "int", "number"
+    # or "choice"; `choices` maps accepted strings to the stored values and
+    # minimum/maximum bound numbers. The checks are compiled once into
+    # `coerce`, which returns (value, None) or (None, error message).
+    # Integers SQLite can store, the default bounds of every int field
+    int_max = 2 ** 63 - 1
+
+    def __init__(self, name, kind, required=True, default=None, choices=None, minimum=None, maximum=None):
+        self.name = name
+        self.kind = kind
+        self.required = required
+        self.default = default
+        self.choices = choices
+        if kind == "int":
+            minimum = -self.int_max if minimum is None else minimum
+            maximum = self.int_max if maximum is None else maximum
+        self.minimum = minimum
+        self.maximum = maximum
+        self.coerce = self.compile()
+
+    def compile(self):
+        name, choices, minimum, maximum = self.name, self.choices, self.minimum, self.maximum
+        if self.kind == "choice":
+            message = f"{name} must be one of {', '.join(choices)}"
+
+            def coerce(value):
+                result = choices.get(value) if isinstance(value, str) else None
+                return (None, message) if result is None else (result, None)
+            return coerce
+
+        if self.kind in ("string", "email"):
+            email = self.kind == "email"
+
+            def coerce(value):
+                if not isinstance(value, str):
+                    return None, f"{name} must be a string"
+                if email and ("@" not in value or "." not in value):
+                    return None, f"{name} isn't a valid email address"
+                return value, None
+            return coerce
+
+        integer = self.kind == "int"
+        message = f"{name} must be {'an integer' if integer else 'a number'}"
+        bounds = self.bounds_message()
+
+        def coerce(value):
+            if integer and type(value) is int:
+                number = value
+            else:
+                if isinstance(value, bool):
+                    return None, message
+                try:
+                    number = float(value)
+                except (TypeError, ValueError, OverflowError):
+                    return None, message
+                if not math.isfinite(number) or (integer and not number.is_integer()):
+                    return None, message
+                if integer:
+                    number = int(number)
+            if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+                return None, bounds
+            return number, None
+        return coerce
+
+    def bounds_message(self):
+        if self.minimum is not None and self.maximum is not None:
+            return f"{self.name} must be between {self.minimum} and {self.maximum}"
+        if self.minimum is not None:
+            return f"{self.name} must be at least {self.minimum}"
+        return f"{self.name} must be at most {self.maximum}"
+
+    @staticmethod
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError, OverflowError):
+            return math.nan
+
+    def vectorize(self, column):
+        # Coerce a whole column with NumPy. Returns (values array, flagged
+        # mask); flagged rows go through coerce() one by one, which reports the
+        # error or, for values NumPy cannot represent exactly, the value.
+        count = len(column)
+        types = numpy.fromiter(map(type, column), dtype=object, count=count)
+        if self.kind == "choice":
+            values = numpy.fromiter((self.choices.get(value) if type(value) is str else None for value in column),
+                                    dtype=object, count=count)
+            return values, numpy.equal(values, None)
+        if self.kind in ("string", "email"):
+            values = numpy.fromiter(column, dtype=object, count=count)
+            flagged = (types != str) | (values == "")
+            if self.kind == "email":
+                flagged |= numpy.fromiter((type(value) is not str or "@" not in value or "." not in value
+                                           for value in column), dtype=bool, count=count)
+            return values, flagged
+        try:
+            numbers = numpy.array(column, dtype=numpy.float64)
+            if numbers.shape != (count,):
+                raise ValueError("column is not flat")
+        except (TypeError, ValueError, OverflowError):
+            numbers = numpy.fromiter(map(_field.to_float, column), dtype=numpy.float64, count=count)
+        flagged = ~numpy.isfinite(numbers) | (types == bool)
+        if self.minimum is not None:
+            flagged |= numbers < self.minimum
+        if self.maximum is not None:
+            flagged |= numbers > self.maximum
+        if self.kind == "int":
+            with numpy.errstate(invalid="ignore"):
+                # From 2**53 on a float no longer holds every integer exactly,
+                # 2**53 + 1 rounds to 2**53 itself
+                flagged |= (numpy.mod(numbers, 1) != 0) | (numpy.abs(numbers) >= 2 ** 53)
+            numbers = numpy.where(flagged, 0, numbers).astype(numpy.int64)
+        return numbers, flagged
+
+
+class _schema:
+    # A payload made of declared fields. validate() checks one payload and
+    # validate_batch() a list of them, column by column when NumPy is there.
+    # Both coerce every value once and return structured field errors,
+    # [{"field": name, "message": text}].
+    # Below this many rows the per-row checks beat building arrays
+    vector_min = 64
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.names = tuple(field.name for field in fields)
+        self._checks = tuple((field.name, field.coerce, field.required, field.default) for field in fields)
+
+    def validate(self, payload):
+        # Return (values, None) with every declared field coerced, or (None, errors)
+        if not isinstance(payload, dict):
+            return None, [{"field": None, "message": "payload must be an object"}]
+        values, errors = {}, []
+        for name, coerce, required, default in self._checks:
+            value = payload.get(name)
+            if value is None or value == "":
+                if required:
+                    errors.append({"field": name, "message": f"{name} is required"})
+                else:
+                    values[name] = default
+                continue
+            value, error = coerce(value)
+            if error:
+                errors.append({"field": name, "message": error})
+            else:
+                values[name] = value
+        return (None, errors) if errors else (values, None)
+
+    def validate_batch(self, rows):
+        # Validate many payloads at once. Returns (indexes, values, errors):
+        # the positions of the valid rows with their values as tuples in field
+        # order, and (position, errors) for every invalid row.
+        if numpy is None or len(rows) < self.vector_min:
+            return self.validate_rows(rows, range(len(rows)))
+        count = len(rows)
+        payloads = [row if isinstance(row, dict) else {} for row in rows]
+        flagged = numpy.fromiter((not isinstance(row, dict) for row in rows), dtype=bool, count=count)
+        columns = []
+        for field in self.fields:
+            values, field_flagged = field.vectorize([payload.get(field.name) for payload in payloads])
+            flagged |= field_flagged
+            columns.append(values)
+        clean = numpy.flatnonzero(~flagged)
+        indexes = clean.tolist()
+        values = list(zip(*(column[clean].tolist() for column in columns)))
+        suspects = numpy.flatnonzero(flagged).tolist()
+        if not suspects:
+            return indexes, values, []
+        rescued_indexes, rescued, errors = self.validate_rows([rows[index] for index in suspects], suspects)
+        if rescued:
+            merged = sorted(zip(indexes + rescued_indexes, values + rescued))
+            indexes, values = [index for index, _ in merged], [row for _, row in merged]
+        return indexes, values, errors
+
+    def validate_rows(self, rows, positions):
+        indexes, values, errors = [], [], []
+        for position, row in zip(positions, rows):
+            row_values, row_errors = self.validate(row)
+            if row_errors:
+                errors.append((position, row_errors))
+            else:
+                indexes.append(position)
+                values.append(tuple(row_values[name] for name in self.names))
+        return indexes, values, errors
+
+    @staticmethod
+    def message(errors):
+        return "; ".join(error["message"] for error in errors)
+
+
+class _schemas:
+    # Status names accepted by the API and the codes stored in climes.status
+    statuses = {"DENIED": 0, "APPROVED": 1, "PENDING": 2}
+    status_names = {code: name for name, code in statuses.items()}
+    report_formats = {"csv": "csv", "ndjson": "ndjson"}
+    search_modes = {"prefix": "prefix", "fuzzy": "fuzzy"}
+    # Largest page size a client may request
+    max_per_page = 1000
+    # Largest page number whose offset still fits a SQLite integer
+    max_page = _field.int_max // max_per_page
+
+    claim = _schema(
+        _field("patient_name", "string"),
+        _field("diagnosis_code", "int"),
+        _field("procedure_code", "int"),
+        _field("claim_amount", "number"),
+    )
+    status = _schema(_field("status", "choice", choices=statuses))
+    claim_filters = _schema(
+        _field("status", "choice", required=False, choices=statuses),
+        _field("diagnosis_code", "int", required=False),
+        _field("procedure_code", "int", required=False),
+    )
+    listing = _schema(
+        _field("page", "int", required=False, default=1, minimum=1, maximum=max_page),
+        _field("per_page", "int", required=False, default=20, minimum=1, maximum=max_per_page),
+        *claim_filters.fields,
+    )
+    report = _schema(
+        _field("status", "choice", choices=statuses),
+        _field("format", "choice", required=False, default="csv", choices=report_formats),
+    )
+    search = _schema(
+        _field("q", "string"),
+        _field("match", "choice", required=False, default="prefix", choices=search_modes),
+        _field("per_page", "int", required=False, default=20, minimum=1, maximum=max_per_page),
+        *claim_filters.fields,
+    )
+    login = _schema(_field("email", "string"), _field("password", "string"))
+    signup = _schema(_field("name", "string"), _field("email", "email"), _field("password", "string"))
@@ -1,218 +1,464 @@
-from flask import request, jsonify, Flask, send_file
+from flask import request, jsonify, Flask, Blueprint, current_app, send_file, Response, stream_with_context, url_for
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required
-from _db_helper import _db_query
-from _validator import _validator
-import csv
+from _db_helper import _db, _db_query, _search, _init__db
+from _schema import _field, _schema, _schemas
+from _ingest import _ingest
+from _reports import _reports
+from _cache import _cache
+from _hasher import _hasher
+from _metrics import _metrics
+from _log import _log
+import os
+import json
+import time
+import base64
+import hashlib
 from celery import Celery
-import uuid
 
-# Initialize Flask application
-app = Flask(__name__)
+# Routes are collected on a blueprint and attached to an application by create_app()
+api = Blueprint("claims", __name__)
 
-# Set Flask secret key for session management
-app.config['SECRET_KEY'] = "4b5f41a0d9a7c3e813bb642b7c2e1f29a5c92b4a614f17d24b8f32ed"
+# Initialize Celery for asynchronous task processing
+celery = Celery("app", broker=os.environ.get('CELERY_BROKER_URL', 'pyamqp://guest@localhost//'))
 
-# Initialize JWT manager for handling authentication tokens
-JWTManager(app)
+# Application built on first access to `app.app`
+_application = None
 
-# Initialize Celery for asynchronous task processing
-celery = Celery(app.name, broker='pyamqp://guest@localhost//')
+def create_app(config=None):
+    # Build the Flask application. Logging, database migrations and metrics
+    # hooks are set up here rather than at import time, so importing the
+    # module (Celery workers, tooling) stays cheap.
+    _log.configure()
+    # Refuse to start on a half migrated schema
+    result = _init__db()
+    if isinstance(result, str):
+        raise RuntimeError(result)
+
+    # Initialize Flask application
+    application = Flask(__name__)
+
+    # Set Flask secret key for session management
+    application.config['SECRET_KEY'] = "4b5f41a0d9a7c3e813bb642b7c2e1f29a5c92b4a614f17d24b8f32ed"
+    # Let a fronting nginx/Apache send report files itself
+    application.config['USE_X_SENDFILE'] = os.environ.get('CLAIMS_USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    application.config.update(config or {})
+
+    # Initialize JWT manager for handling authentication tokens
+    JWTManager(application)
+
+    # Record per-route latency histograms
+    _metrics.install(application)
+
+    application.register_blueprint(api)
+    return application
 
-# Dictionary to store job status by job ID
-jobs = {}
+def invalid(errors, status_code=400):
+    # Response for a payload that failed schema validation, one entry per bad field
+    return jsonify({"error": True, "message": _schema.message(errors), "fields": errors}), status_code
+
+def __getattr__(name):
+    # `app:app` keeps working for WSGI servers, built lazily on first access
+    global _application
+    if name == "app":
+        if _application is None:
+            _application = create_app()
+        return _application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class Metrics:
+    # Cache and connection pool gauges added to every scrape
+    def collect():
+        samples = []
+        for name, cache in (("claims", _cache.claims), ("identities", _cache.identities)):
+            stats = cache.stats()
+            samples.append(("claims_cache_entries", "gauge", "Entries held by the cache", [({"cache": name}, stats["size"])]))
+            for counter in ("hits", "misses", "evictions", "expirations", "invalidations"):
+                samples.append((f"claims_cache_{counter}_total", "counter", f"Cache {counter}", [({"cache": name}, stats[counter])]))
+        reports = _reports.stats()
+        for counter in ("requests", "hits", "joined", "misses", "evicted_files", "bytes_reclaimed"):
+            samples.append((f"claims_report_{counter}_total", "counter", f"Report cache {counter.replace('_', ' ')}", [({}, reports[counter])]))
+        pools = [({"shard": str(shard)}, _db.pool(shard).stats()) for shard in range(_db.shards)]
+        samples.append(("claims_db_pool_connections", "gauge", "Pooled database connections",
+                        [({"state": "open", **labels}, pool["opened"]) for labels, pool in pools] +
+                        [({"state": "idle", **labels}, pool["idle"]) for labels, pool in pools]))
+        return samples
+
+    # Endpoint exposing every metric in Prometheus text format
+    @api.route("/metrics", methods=['GET'])
+    def metrics():
+        return Response(_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+_metrics.register(Metrics.collect)
 
 class Report:
+    # Largest report, in rows, that may be streamed inline instead of through a job
+    inline_max_rows = int(os.environ.get('CLAIMS_INLINE_REPORT_MAX_ROWS', 100000))
+
+    # Endpoint to expose report cache and artifact eviction counters
+    @api.route("/stats/reports", methods=['GET'])
+    @jwt_required()
+    def report_stats():
+        return jsonify(_reports.stats())
+
     # Endpoint to download report by task ID
-    @app.route("/download/<task_id>", methods=['GET'])
+    @api.route("/download/<task_id>", methods=['GET'])
     @jwt_required()
     def download_report(task_id):
-        csv_file_path = f"{task_id}_claims_report.csv"
+        found, job = _db_query.get_report_job(task_id)
+        if not found or job["state"] != "completed":
+            return jsonify({"error": True, "message": "File not found or has been removed"}), 404
+        format = job["format"]
+        # Serve the best pre-compressed copy the client accepts, else the plain file
+        encoding = request.accept_encodings.best_match(_reports.available_encodings(task_id, format))
+        mimetype, extension = _reports.formats[format]
         try:
-            # Serve the CSV file as an attachment
-            return send_file(csv_file_path, as_attachment=True)
+            # conditional=True answers Range, If-Range and If-None-Match, and the
+            # file goes out through wsgi.file_wrapper (or X-Sendfile) untouched
+            path = _reports.report_path(task_id, format, encoding) if encoding else job["path"]
+            response = send_file(path, mimetype=mimetype, as_attachment=True,
+                                 download_name=f"{task_id}_claims_report.{extension}", conditional=True)
         except FileNotFoundError:
             # Return error if file is not found
             return jsonify({"error": True, "message": "File not found or has been removed"}), 404
+        # Downloads count as use, eviction removes the least recently used reports first
+        _db_query.update_report_job(task_id, accessed_at=time.time())
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.vary.add("Accept-Encoding")
+        return response
+
+    # Endpoint to stream a report straight into the response without a job
+    @api.route("/claims/report/stream", methods=['GET'])
+    @jwt_required()
+    def stream_report():
+        values, errors = _schemas.report.validate(request.args.to_dict())
+        if errors:
+            return invalid(errors)
+        status, format = values["status"], values["format"]
+        count = _db_query.count_claim_data_report(status)
+        if not count[0]:
+            return jsonify({"error": True, "message": count[1]}), 500
+        if count[1] > Report.inline_max_rows:
+            return jsonify({"error": True, "message": f"report has {count[1]} rows, generate it with POST /claims/report instead"}), 413
+        mimetype, extension = _reports.formats[format]
+        headers = {"Content-Disposition": f"attachment; filename={_schemas.status_names[status].lower()}_claims_report.{extension}"}
+        chunks = (text for rows, text in _reports.iter_rows(status, format))
+        return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 
     # Endpoint to check report status and download link by task ID
-    @app.route("/claims/report/<task_id>", methods=['GET'])
+    @api.route("/claims/report/<task_id>", methods=['GET'])
     @jwt_required()
     def check_job_id(task_id):
-        # Return the status of the job and download link
-        if task_id in jobs:
-            if str(jobs[task_id])=="completed":
-                return jsonify({"status": jobs[task_id], "link": f"http://localhost:5000/download/{task_id}"})
-            else:
-                return jsonify({"status": jobs[task_id]})
-        else:
+        # Return the state, progress and timing of the job, plus the download link once completed
+        found, job = _reports.status(task_id)
+        if not found:
             return jsonify({"message": "Cannot find job ID"}), 404
+        body = {key: job[key] for key in ("progress", "rows_written", "total_rows", "created_at", "started_at",
+                                           "finished_at", "queued_seconds", "run_seconds", "error")}
+        body["status"] = job["state"]
+        body["format"] = job["format"]
+        if job["state"] == "completed":
+            body["link"] = url_for(".download_report", task_id=task_id, _external=True)
+            body["encodings"] = _reports.available_encodings(task_id, job["format"])
+        return jsonify(body)
+
     # Celery task to create CSV report
     @celery.task(bind=True)
-    def create_csv_report(self, data):
-        # Generate a unique job ID
-        job_id = str(uuid.uuid4())
-        csv_file_path = f'{job_id}_claims_report.csv'
-        
-        # Write the report data to CSV file
-        jobs[job_id] = 'in progress'
-        try:
-            with open(csv_file_path, 'w', newline='') as csvfile:
-                writer = csv.writer(csvfile)
-                writer.writerow(['Patient Name', 'Diagnosis Code', 'Procedure Code', 'Status', 'Total Claim Amount'])
-                writer.writerows(data)
-            # Update job status to completed
-            jobs[job_id] = 'completed'
-        except Exception as e:
-            # Update job status to failed in case of error
-            jobs[job_id] = 'failed'
-        return job_id
+    def create_csv_report(self, job_id):
+        return _reports.run(job_id)
 
     # Endpoint to generate the report
-    @app.route("/claims/report", methods=['POST'])
+    @api.route("/claims/report", methods=['POST'])
     @jwt_required()
     def genreate_report():
-        status = request.json.get('status')
-        # Validate the status input
-        if not _validator.check_string_type(status) or _validator.convert_type(status) == "Unknown value":
-            return jsonify({"error": True, "message": "status isn't valid type or valid value"}), 500
-         
-        # Retrieve claim data based on status
-        result = _db_query.get_claim_data_report(_validator.convert_type(status))
-        # Create the CSV report using Celery
-        task_id = Report.create_csv_report(result[1])
-        return jsonify({"success": result[0], "task_id": task_id}), 200 if result[0] else 500
+        # Validate the status and format input
+        values, errors = _schemas.report.validate(request.get_json(silent=True))
+        if errors:
+            return invalid(errors)
+
+        # Record the job, then hand it to a Celery worker or the local worker pool
+        # unless an identical report for the current data is already done or underway
+        result = _reports.create(values["status"], values["format"])
+        if not result[0]:
+            return jsonify({"success": False, "message": result[1]}), 500
+        task_id, outcome = result[1]
+        if outcome == "miss":
+            try:
+                if _reports.backend == 'celery':
+                    Report.create_csv_report.delay(task_id)
+                else:
+                    _reports.submit(task_id)
+            except Exception as e:
+                # Nothing will run the job, fail it so the next request starts a new one
+                message = f"cannot queue report job: {e}"
+                _db_query.update_report_job(task_id, state='failed', error=message, finished_at=time.time())
+                return jsonify({"success": False, "message": message}), 500
+        return jsonify({"success": True, "task_id": task_id, "cached": outcome != "miss"}), 200
 
 class ClaimRoutes:
+    # Longest patient name search accepted, in characters
+    search_max_length = 100
+
+    # Endpoint to expose claim cache counters, used to size the cache
+    @api.route("/stats/cache", methods=['GET'])
+    @jwt_required()
+    def cache_stats():
+        return jsonify(_cache.claims.stats())
+
     # Endpoint to delete a claim by ID
-    @app.route("/claims/<int:claim_id>", methods=['DELETE'])
+    @api.route("/claims/<int:claim_id>", methods=['DELETE'])
     @jwt_required()
     def delete_claim(claim_id):
-        # Validate claim_id input
-        if not _validator.check_int_type(claim_id):
-            return jsonify({"error": True, "message": "claim_id isn't a valid int type"})
-        
         # Delete claim by ID and return result
         result = _db_query.delete_claim_by_id(claim_id)
         return jsonify({"success": result[0], "message": result[1]}), 200 if result[0] else 500
 
     # Endpoint to update claim status by ID
-    @app.route("/claims/<int:claim_id>", methods=['PUT'])
+    @api.route("/claims/<int:claim_id>", methods=['PUT'])
     @jwt_required()
     def update_claim_status(claim_id):
-        status = request.json.get("status")
-        # Validate claim_id and status input
-        if not _validator.check_string_type(status) or not _validator.check_int_type(claim_id):
-            return jsonify({"error": True, "message": "claim_id or status are not valid type or valid value"}), 500
-        
-        # Validate status value
-        if _validator.convert_type(status) == "Unknown value":
-            return jsonify({"error": True, "message": "status value isn't valid"}), 500
-        
+        # Validate the status input, claim_id is already an int from the route
+        values, errors = _schemas.status.validate(request.get_json(silent=True))
+        if errors:
+            return invalid(errors)
+
         # Update claim status and return result
-        result = _db_query.update_claim_status(_validator.convert_type(status), claim_id)
+        result = _db_query.update_claim_status(values["status"], claim_id)
         return jsonify({"success": result[0], "message": result[1]}), 200 if result[0] else 500
 
     # Endpoint to get a claim by ID
-    @app.route("/claims/<int:claim_id>", methods=['GET'])
+    @api.route("/claims/<int:claim_id>", methods=['GET'])
     @jwt_required()
     def get_claim_by_id(claim_id):
-        # Validate claim_id input
-        if not _validator.check_int_type(claim_id):
-            return jsonify({"error": True, "message": "claim_id isn't a valid int type"})
-        
-        # Retrieve claim by ID and return result
-        result = _db_query.retrieve_claim_by_id(claim_id)
-        return jsonify({"success": result[0], "message": result[1]}), 200 if result[0] else 500
+        # Serve the cached serialized claim when possible, a matching If-None-Match
+        # is answered with 304 without reading the claim or serializing it. Other
+        # workers write claims too, so a cached copy is only used while the
+        # shared data version of its status is the one it was read at.
+        versions = _db_query.claim_versions(claim_id)
+        cached = _cache.claims.get(claim_id)
+        if cached is not None and (not versions[0] or versions[1].get(cached[2]) != cached[3]):
+            _cache.claims.invalidate(claim_id)
+            cached = None
+        if cached is None:
+            epoch = _cache.claims.epoch()
+            result = _db_query.retrieve_claim_by_id(claim_id)
+            if not result[0]:
+                return jsonify({"success": result[0], "message": result[1]}), 500
+            body = current_app.json.dumps({"success": result[0], "message": result[1]}).encode() + b"\n"
+            # The versions were read before the claim, a write in between
+            # leaves this copy behind and the next request reads it again
+            status = result[1][5]
+            cached = (hashlib.sha1(body).hexdigest(), body, status, versions[1].get(status) if versions[0] else None)
+            if versions[0]:
+                _cache.claims.set(claim_id, cached, epoch)
+        etag, body = cached[:2]
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        return response
+
+    # Encode the last id of a page into an opaque cursor token
+    def encode_cursor(last_id):
+        return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode().rstrip("=")
+
+    # Decode a cursor token, an empty token starts from the first claim
+    def decode_cursor(token):
+        if not token:
+            return 0
+        try:
+            last_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))["id"]
+        except (ValueError, KeyError, TypeError):
+            return None
+        return last_id if isinstance(last_id, int) and 0 <= last_id <= _field.int_max else None
 
     # Endpoint to get a list of claims with optional filters
-    @app.route("/claims", methods=['GET'])
+    @api.route("/claims", methods=['GET'])
     @jwt_required()
     def get_claims():
-        # Get optional filter parameters
-        status = request.args.get('status')
-        diagnosis_code = request.args.get('diagnosis_code')
-        procedure_code = request.args.get('procedure_code')
-        page = request.args.get('page')
-        per_page = request.args.get('per_page')
-
-        # Check if all required parameters are provided
-        if not (status and diagnosis_code and procedure_code and page and per_page):
-            return jsonify({"error": True, "message": "All parameters must be provided"}), 400
-        # Validate the input values
-        try:
-            page = int(page)
-            per_page = int(per_page)
-        except ValueError:
-            return jsonify({"error": True, "message": "page and per_page must be integers"}), 500
-
-        if not _validator.check_string_type(status):
-            return jsonify({"error": True, "message": "status must be a string"}), 400
-        if not _validator.check_int_type(diagnosis_code, procedure_code, page, per_page):
-            return jsonify({"error": True, "message": "diagnosis_code, procedure_code, page, and per_page must be integers"}), 400
-        if _validator.convert_type(status) == "Unknown value":
-            return jsonify({"error": True, "message": "status value isn't valid"}), 400
+        # Validate paging and the optional filter parameters in one pass
+        values, errors = _schemas.listing.validate(request.args.to_dict())
+        if errors:
+            return invalid(errors)
+        page, per_page = values.pop("page"), values.pop("per_page")
+        filters = values
+
+        # Cursor mode pages on id so every page costs the same regardless of depth
+        if 'cursor' in request.args:
+            after_id = ClaimRoutes.decode_cursor(request.args.get('cursor'))
+            if after_id is None:
+                return jsonify({"error": True, "message": "cursor isn't valid"}), 400
+            result = _db_query.get_claim_data_after(per_page, after_id, **filters)
+            next_cursor = ClaimRoutes.encode_cursor(result[2]) if result[2] is not None else None
+            return jsonify({"success": result[0], "message": result[1], "next_cursor": next_cursor}), 200 if result[0] else 500
+
         # Retrieve claim data with the specified filters
-        result = _db_query.get_claim_data(per_page, page, diagnosis_code, procedure_code, _validator.convert_type(status))
+        result = _db_query.get_claim_data(per_page, page, **filters)
         return jsonify({"success": result[0], "message": result[1]}), 200 if result[0] else 500
 
+    # Endpoint to search claims by patient name, with the listing filters and cursor paging
+    @api.route("/claims/search", methods=['GET'])
+    @jwt_required()
+    def search_claims():
+        values, errors = _schemas.search.validate(request.args.to_dict())
+        if errors:
+            return invalid(errors)
+        text, match, per_page = values.pop("q"), values.pop("match"), values.pop("per_page")
+        words = text.split()
+        if len(text) > ClaimRoutes.search_max_length or not any(char.isalnum() for char in text):
+            return invalid([{"field": "q", "message": f"q must contain a word and at most {ClaimRoutes.search_max_length} characters"}])
+        if match == "fuzzy" and not _search.fuzzy:
+            return invalid([{"field": "match", "message": "fuzzy search is not enabled on this server"}])
+        # The trigram index only holds substrings of three characters or more
+        if match == "fuzzy" and any(len(word) < 3 for word in words):
+            return invalid([{"field": "q", "message": "every word of a fuzzy search needs at least 3 characters"}])
+        after_id = ClaimRoutes.decode_cursor(request.args.get('cursor'))
+        if after_id is None:
+            return jsonify({"error": True, "message": "cursor isn't valid"}), 400
+        result = _db_query.search_claims(text, per_page, after_id, match, **values)
+        next_cursor = ClaimRoutes.encode_cursor(result[2]) if result[2] is not None else None
+        return jsonify({"success": result[0], "message": result[1], "next_cursor": next_cursor}), 200 if result[0] else 500
+
     # Endpoint to add a new claim
-    @app.route("/claims", methods=['POST'])
+    @api.route("/claims", methods=['POST'])
     @jwt_required()
     def add_claim():
-        # Get input values
-        patient_name = request.json.get('patient_name')
-        diagnosis_code = request.json.get('diagnosis_code')
-        procedure_code = request.json.get('procedure_code')
-        claim_amount = request.json.get('claim_amount')
-        if not (patient_name and diagnosis_code and procedure_code and claim_amount):
-            return jsonify({"error": True, "message": "All data must be provided"}), 400
-        # Validate the input values
-        if _validator.check_null_values(patient_name, diagnosis_code, procedure_code, claim_amount):
-            return jsonify({"error": "Missing values"}), 400
-        if not _validator.check_int_type(diagnosis_code, procedure_code, claim_amount):
-            return jsonify({"error": "diagnosis_code and procedure_code must be integers, claim_amount must be a number"}), 400
-        
+        # Validate and coerce the input values
+        values, errors = _schemas.claim.validate(request.get_json(silent=True))
+        if errors:
+            return invalid(errors)
+
         # Add new claim and return result
-        result = _db_query.add_claim(patient_name, diagnosis_code, procedure_code, claim_amount)
+        result = _db_query.add_claim(*(values[name] for name in _schemas.claim.names))
         return jsonify({"success": result[0], "message": result[1]}), 200 if result[0] else 500
 
+    # Endpoint to ingest many claims at once from a JSON array, NDJSON or CSV body
+    @api.route("/claims/bulk", methods=['POST'])
+    @jwt_required()
+    def add_claims_bulk():
+        batch_size = request.args.get('batch_size', str(_ingest.batch_size))
+        if not batch_size.isdigit() or not 1 <= int(batch_size) <= _ingest.max_batch_size:
+            return jsonify({"error": True, "message": f"batch_size must be an integer between 1 and {_ingest.max_batch_size}"}), 400
+
+        # A multipart upload carries the rows in its "file" part, any other body is read as a stream
+        if request.mimetype == "multipart/form-data":
+            upload = request.files.get('file')
+            if upload is None:
+                return jsonify({"error": True, "message": "file part is missing"}), 400
+            content_type = upload.mimetype
+            if upload.filename.endswith(".csv"):
+                content_type = "text/csv"
+            elif upload.filename.endswith((".ndjson", ".jsonl")):
+                content_type = "application/x-ndjson"
+            stream = upload.stream
+        else:
+            content_type, stream = request.mimetype, request.stream
+        try:
+            rows = _ingest.iter_rows(stream, content_type)
+        except _ingest.ParseError as e:
+            return jsonify({"error": True, "message": str(e)}), 415
+
+        ok, summary = _ingest.ingest(rows, int(batch_size))
+        summary["success"] = ok and not summary["rejected"]
+        return jsonify(summary), 200 if ok else 400
+
+    # Largest number of ids a bulk update or delete may name
+    max_bulk_ids = 100000
+
+    # Validate the "ids" or "filter" target of a bulk request, returning (ids, filters, field errors)
+    def parse_bulk_target(body):
+        ids, claim_filter = body.get('ids'), body.get('filter')
+        if (ids is None) == (claim_filter is None):
+            return None, None, [{"field": None, "message": "provide either ids or filter"}]
+        if ids is not None:
+            if not isinstance(ids, list) or not ids or len(ids) > ClaimRoutes.max_bulk_ids:
+                return None, None, [{"field": "ids", "message": f"ids must be a list of 1 to {ClaimRoutes.max_bulk_ids} claim ids"}]
+            if not all(type(claim_id) is int and 1 <= claim_id <= _field.int_max for claim_id in ids):
+                return None, None, [{"field": "ids", "message": f"ids must be integers from 1 to {_field.int_max}"}]
+            return list(dict.fromkeys(ids)), None, None
+        if not isinstance(claim_filter, dict) or not claim_filter or set(claim_filter) - set(_schemas.claim_filters.names):
+            return None, None, [{"field": "filter", "message": "filter must set at least one of status, diagnosis_code and procedure_code"}]
+        filters, errors = _schemas.claim_filters.validate(claim_filter)
+        if errors:
+            return None, None, errors
+        # A filter of only nulls or blanks would select every claim
+        if all(value is None for value in filters.values()):
+            return None, None, [{"field": "filter", "message": "filter must set at least one of status, diagnosis_code and procedure_code"}]
+        return None, filters, None
+
+    # Build the bulk response with one outcome per requested id
+    def bulk_outcomes(ids, affected, outcome):
+        if ids is None:
+            return {"success": True, outcome: len(affected), "ids": affected}
+        affected = set(affected)
+        results = [{"id": claim_id, "outcome": outcome if claim_id in affected else "not_found"} for claim_id in ids]
+        return {"success": True, outcome: len(affected), "not_found": len(ids) - len(affected), "results": results}
+
+    # Endpoint to set the status of many claims in one statement
+    @api.route("/claims/bulk", methods=['PUT'])
+    @jwt_required()
+    def update_claims_status_bulk():
+        body = request.get_json(silent=True) or {}
+        values, errors = _schemas.status.validate(body)
+        if errors:
+            return invalid(errors)
+        ids, filters, errors = ClaimRoutes.parse_bulk_target(body)
+        if errors:
+            return invalid(errors)
+
+        result = _db_query.update_claims_status(values["status"], ids, filters)
+        if not result[0]:
+            return jsonify({"success": False, "message": result[1]}), 500
+        return jsonify(ClaimRoutes.bulk_outcomes(ids, result[1], "updated")), 200
+
+    # Endpoint to delete many claims in one statement
+    @api.route("/claims/bulk", methods=['DELETE'])
+    @jwt_required()
+    def delete_claims_bulk():
+        ids, filters, errors = ClaimRoutes.parse_bulk_target(request.get_json(silent=True) or {})
+        if errors:
+            return invalid(errors)
+
+        result = _db_query.delete_claims(ids, filters)
+        if not result[0]:
+            return jsonify({"success": False, "message": result[1]}), 500
+        return jsonify(ClaimRoutes.bulk_outcomes(ids, result[1], "deleted")), 200
+
 class AuthRoutes:
     # Endpoint for user login
-    @app.route("/auth/login", methods=['POST'])
+    @api.route("/auth/login", methods=['POST'])
     def login():
-        # Get login credentials
-        email = request.json.get('email')
-        password = request.json.get('password')
-        
-        # Validate the input values
-        if not _validator.check_null_values(email, password):
-            result = _db_query.login(email, password)
-            if not result:
-                return jsonify(message="Invalid credentials"), 401
-            else:
-                # Create access token if credentials are valid
-                return jsonify({"access_token": create_access_token(identity=email)}), 200 # return auth token by email identity.
+        # Validate the login credentials
+        values, errors = _schemas.login.validate(request.get_json(silent=True))
+        if errors:
+            return invalid(errors)
+        try:
+            result = _db_query.login(values["email"], values["password"])
+        except _hasher.Busy:
+            return jsonify({"error": True, "message": "Too many concurrent logins, retry shortly"}), 503
+        if not result:
+            return jsonify(message="Invalid credentials"), 401
         else:
-            return jsonify({"error": "Missing values"}), 400
+            # Create access token if credentials are valid
+            return jsonify({"access_token": create_access_token(identity=values["email"])}), 200 # return auth token by email identity.
     # Endpoint for user signup
-    @app.route("/auth/signup", methods=['POST'])
+    @api.route("/auth/signup", methods=['POST'])
     def signup():
-        name = request.json.get('name')
-        email = request.json.get('email')
-        password = request.json.get('password')
-        # Validate the input values
-        if not _validator.check_null_values(name, email, password): # check if theres any none values .
-            if "@" not in email or "." not in email:
-                return jsonify({"success": False, "error": "Invalid email address"}), 400
-            else:
-                result = _db_query.add_user(name, email, password)
-                return jsonify({"success": result[0], "message": result[1]}), 200
-        else:
-            return jsonify({"error": True, "message": "Missing field"}), 400
+        # Validate the input values, the email must look like an address
+        values, errors = _schemas.signup.validate(request.get_json(silent=True))
+        if errors:
+            return invalid(errors)
+        try:
+            result = _db_query.add_user(values["name"], values["email"], values["password"])
+        except _hasher.Busy:
+            return jsonify({"error": True, "message": "Too many concurrent signups, retry shortly"}), 503
+        return jsonify({"success": result[0], "message": result[1]}), 200
 
 # Main function to run the Flask application
 def __main__():
-    app.run(debug=True,port=5000)
+    create_app().run(debug=True,port=5000)
 
 if __name__ == "__main__":
     __main__()
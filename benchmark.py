@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Scenarios in the order they run, writes come last so reads see the seeded data
+SCENARIOS = ("post_claim", "list_shallow", "list_deep_offset", "list_deep_cursor", "get_claim",
+             "login", "login_cold", "report_cold", "report_cached", "put_claim", "delete_claim")
+# Statistics compared against a baseline, "lower" means smaller is better
+COMPARED = {"p95_ms": "lower", "throughput_per_s": "higher"}
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        "iterations": len(ordered),
+        "throughput_per_s": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def seed(path, claims, rng, batch_size=50000):
+    # Insert synthetic claims straight through sqlite3, much faster than the API
+    conn = sqlite3.connect(path)
+    rows = ((f"patient {rng.randrange(claims // 4 + 1)}", rng.randrange(1, 500), rng.randrange(1, 200),
+             round(rng.uniform(10, 5000), 2), rng.randrange(3)) for _ in range(claims))
+    query = "INSERT INTO climes (patient_name, diagnosis_code, procedure_code, claim_amount, status) VALUES (?, ?, ?, ?, ?)"
+    while True:
+        batch = [row for _, row in zip(range(batch_size), rows)]
+        if not batch:
+            break
+        conn.executemany(query, batch)
+        conn.commit()
+    conn.close()
+
+
+def measure(run, iterations, warmup):
+    for _ in range(warmup):
+        run()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - begin)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def run_benchmarks(args):
+    # The database and report files live in a scratch directory that is
+    # removed afterwards, even when a scenario fails, unless --keep is given
+    previous = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="claims-bench-")
+    try:
+        return benchmark(args, workdir)
+    finally:
+        os.chdir(previous)
+        if "_db_helper" in sys.modules:
+            from _db_helper import _db
+            from _reports import _reports
+            _reports.shutdown(wait=True)
+            _db.close_pool()
+        if args.keep:
+            print(f"Kept the benchmark files in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def benchmark(args, workdir):
+    os.chdir(workdir)
+    os.environ["CLAIMS_DB_PATH"] = os.path.join(workdir, "claims.db")
+    # Report jobs run on in-process threads instead of a Celery broker
+    os.environ["CLAIMS_REPORT_BACKEND"] = "thread"
+    os.environ.setdefault("CLAIMS_LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    import app as application
+    from _cache import _cache
+    from _db_helper import _db_query
+    from _schema import _schemas
+
+    # Building the app applies the migrations the seed data needs
+    client = application.create_app().test_client()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    seed(os.environ["CLAIMS_DB_PATH"], args.claims, rng)
+    seed_seconds = round(time.perf_counter() - started, 2)
+
+    credentials = {"name": "bench", "email": "bench@example.com", "password": "bench-password"}
+    client.post("/auth/signup", json=credentials)
+    token = client.post("/auth/login", json=credentials).get_json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    per_page = 50
+    deep_page = max(1, args.claims // per_page - 1)
+    deep_cursor = application.ClaimRoutes.encode_cursor(max(0, args.claims - per_page * 2))
+    statuses = ("DENIED", "APPROVED", "PENDING")
+
+    def check(response, *expected):
+        if response.status_code not in (expected or (200,)):
+            raise RuntimeError(f"{response.request.method} {response.request.path} returned {response.status_code}: {response.data[:200]!r}")
+        return response
+
+    def post_claim():
+        check(client.post("/claims", headers=headers, json={
+            "patient_name": f"patient {rng.randrange(1000)}", "diagnosis_code": rng.randrange(1, 500),
+            "procedure_code": rng.randrange(1, 200), "claim_amount": round(rng.uniform(10, 5000), 2)}))
+
+    def list_shallow():
+        check(client.get(f"/claims?page=1&per_page={per_page}", headers=headers))
+
+    def list_deep_offset():
+        check(client.get(f"/claims?page={deep_page}&per_page={per_page}", headers=headers))
+
+    def list_deep_cursor():
+        check(client.get(f"/claims?per_page={per_page}&cursor={deep_cursor}", headers=headers))
+
+    def get_claim():
+        check(client.get(f"/claims/{rng.randrange(1, args.claims + 1)}", headers=headers))
+
+    def login():
+        check(client.post("/auth/login", json=credentials))
+
+    def login_cold():
+        # Forget verified identities so every login pays for the password hash
+        _cache.identities.clear()
+        check(client.post("/auth/login", json=credentials))
+
+    def report(status):
+        task_id = check(client.post("/claims/report", headers=headers, json={"status": status})).get_json()["task_id"]
+        while True:
+            state = check(client.get(f"/claims/report/{task_id}", headers=headers)).get_json()["status"]
+            if state == "completed":
+                return
+            if state == "failed":
+                raise RuntimeError(f"report job {task_id} failed")
+            time.sleep(0.01)
+
+    def report_cold():
+        # Change a claim first so the status has a new data version and the
+        # report is generated again instead of served from the cache
+        status = rng.choice(statuses)
+        _db_query.update_claim_status(_schemas.statuses[status], rng.randrange(1, args.claims + 1))
+        report(status)
+
+    def report_cached():
+        # After the warmup this is always an already generated report
+        report("PENDING")
+
+    def put_claim():
+        check(client.put(f"/claims/{rng.randrange(1, args.claims + 1)}", headers=headers, json={"status": rng.choice(statuses)}))
+
+    deleted = iter(rng.sample(range(1, args.claims + 1), min(args.claims, args.iterations + args.warmup)))
+
+    def delete_claim():
+        check(client.delete(f"/claims/{next(deleted)}", headers=headers), 200, 500)
+
+    runners = {"post_claim": post_claim, "list_shallow": list_shallow, "list_deep_offset": list_deep_offset,
+               "list_deep_cursor": list_deep_cursor, "get_claim": get_claim, "login": login, "login_cold": login_cold,
+               "report_cold": report_cold, "report_cached": report_cached, "put_claim": put_claim, "delete_claim": delete_claim}
+    # Scenarios that are slow by design run fewer iterations
+    iteration_caps = {"login_cold": 20, "report_cold": 20}
+
+    results = {}
+    for name in SCENARIOS:
+        if args.scenarios and name not in args.scenarios:
+            continue
+        iterations = min(args.iterations, iteration_caps.get(name, args.iterations))
+        results[name] = measure(runners[name], iterations, min(args.warmup, iterations))
+        print(f"{name:18} {json.dumps(results[name])}", file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(), "claims": args.claims, "iterations": args.iterations,
+            "seed": args.seed, "seed_seconds": seed_seconds, "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+        },
+        "peak_rss_mb": peak_rss_mb(),
+        "scenarios": results,
+    }
+
+
+def compare(results, baseline, threshold):
+    # Return every statistic that regressed by more than `threshold` (a fraction)
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for stat, better in COMPARED.items():
+            old, new = previous.get(stat), current.get(stat)
+            if not old or new is None:
+                continue
+            change = (new - old) / old if better == "lower" else (old - new) / old
+            if change > threshold:
+                regressions.append({"scenario": name, "stat": stat, "baseline": old, "current": new,
+                                    "regression": round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load and micro-benchmarks for the claims API")
+    parser.add_argument("--claims", type=int, default=10000, help="claims to seed the database with")
+    parser.add_argument("--iterations", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests before each scenario")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for data and requests")
+    parser.add_argument("--scenarios", nargs="*", choices=SCENARIOS, help="only run these scenarios")
+    parser.add_argument("--output", help="write the results JSON to this file")
+    parser.add_argument("--baseline", help="results JSON of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression as a fraction, default 0.2")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary database and report files")
+    args = parser.parse_args(argv)
+
+    # Loaded up front, the benchmark changes the working directory
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    output = os.path.abspath(args.output) if args.output else None
+
+    results = run_benchmarks(args)
+    if baseline is not None:
+        results["regressions"] = compare(results, baseline, args.threshold)
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return 1 if results.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
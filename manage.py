@@ -0,0 +1,90 @@
+import argparse
+import json
+import sys
+from _db_helper import _migrations, _aggregates, _archive, _shards
+from _log import _log
+
+
+# Apply any pending schema migrations
+def migrate(args):
+    applied = _migrations.apply()
+    print(json.dumps({"applied": applied}))
+    return 0
+
+
+# Fail when a hot path query stops using its index, meant to run in CI
+def check_plans(args):
+    ok, failures = _migrations.check_query_plans()
+    print(json.dumps({"ok": ok, "failures": failures}, indent=2))
+    return 0 if ok else 1
+
+
+# Diff the claim_totals aggregate against a full recomputation
+def verify_aggregates(args):
+    ok, report = _aggregates.verify(args.max_differences)
+    print(json.dumps({"ok": ok, **report}, indent=2))
+    return 0 if ok else 1
+
+
+# Recompute the claim_totals aggregate from scratch
+def rebuild_aggregates(args):
+    print(json.dumps({"rows": _aggregates.rebuild()}))
+    return 0
+
+
+# Remove report artifacts past the age or size limits
+def evict_reports(args):
+    from _reports import _reports
+    if args.max_age is not None:
+        _reports.max_age = args.max_age
+    if args.max_bytes is not None:
+        _reports.max_bytes = args.max_bytes
+    print(json.dumps(_reports.evict()))
+    return 0
+
+
+# Move claims older than the horizon into the yearly archive partitions
+def archive(args):
+    print(json.dumps(_archive.run(args.older_than_days, args.batch_size, args.max_batches, args.pause), indent=2))
+    return 0
+
+
+# Move claims to the shard their id routes to after CLAIMS_DB_SHARDS changed
+def rebalance_shards(args):
+    print(json.dumps(_shards.rebalance(args.batch_size, args.pause), indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Claims database maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="apply pending schema migrations").set_defaults(func=migrate)
+    commands.add_parser("check-plans", help="verify hot path queries use their indexes").set_defaults(func=check_plans)
+    verify = commands.add_parser("verify-aggregates", help="diff claim_totals against a full recomputation")
+    verify.add_argument("--max-differences", type=int, default=100, help="differences to print at most")
+    verify.set_defaults(func=verify_aggregates)
+    commands.add_parser("rebuild-aggregates", help="recompute claim_totals from scratch").set_defaults(func=rebuild_aggregates)
+    evict = commands.add_parser("evict-reports", help="remove report files past the age or size limits")
+    evict.add_argument("--max-age", type=int, help="seconds a report is kept, default CLAIMS_REPORT_MAX_AGE")
+    evict.add_argument("--max-bytes", type=int, help="bytes all reports may take, default CLAIMS_REPORT_MAX_BYTES")
+    evict.set_defaults(func=evict_reports)
+    move = commands.add_parser("archive", help="move old claims into archive partitions")
+    move.add_argument("--older-than-days", type=int, help="archive claims submitted before this, default CLAIMS_ARCHIVE_AFTER_DAYS")
+    move.add_argument("--batch-size", type=int, help="claims moved per batch, default CLAIMS_ARCHIVE_BATCH_SIZE")
+    move.add_argument("--max-batches", type=int, help="stop after this many batches")
+    move.add_argument("--pause", type=float, help="seconds to sleep between batches, default CLAIMS_ARCHIVE_PAUSE")
+    move.set_defaults(func=archive)
+    rebalance = commands.add_parser("rebalance-shards", help="move claims into the shard their id routes to")
+    rebalance.add_argument("--batch-size", type=int, help="claims moved per batch, default CLAIMS_SHARD_BATCH_SIZE")
+    rebalance.add_argument("--pause", type=float, help="seconds to sleep between batches, default CLAIMS_SHARD_PAUSE")
+    rebalance.set_defaults(func=rebalance_shards)
+    args = parser.parse_args(argv)
+    _log.configure()
+    # Every other command expects an up to date schema
+    if args.func is not migrate:
+        _migrations.apply()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
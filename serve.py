@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import contextvars
+import io
+import os
+import sys
+import tempfile
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.wsgi import FileWrapper
+
+logger = logging.getLogger("claims.serve")
+
+
+class _lane:
+    # A bounded thread pool plus an admission limit: at most `threads` requests
+    # run at once and at most `queue_size` more wait. Anything beyond that is
+    # rejected up front instead of piling up.
+    def __init__(self, name, threads, queue_size):
+        self.name = name
+        self.capacity = threads + queue_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"serve-{name}")
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def try_admit(self):
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "capacity": self.capacity, "rejected": self.rejected}
+
+
+class AsyncServer:
+    # ASGI front end for the Flask application. The event loop only moves
+    # bytes; every request runs on a thread of its lane so blocking SQLite work
+    # never stalls the loop, and slow routes (reports, bulk operations) get a
+    # lane of their own so they cannot starve point lookups.
+    slow_prefixes = ("/claims/report", "/claims/bulk", "/download")
+    # Request bodies larger than this are spooled to a temporary file
+    spool_size = 1024 * 1024
+    # Response bytes gathered on a worker thread before handing them to the loop
+    chunk_size = 256 * 1024
+
+    def __init__(self, wsgi_app, threads=16, queue_size=64, slow_threads=4, slow_queue_size=16, drain_timeout=30.0):
+        self.wsgi_app = wsgi_app
+        self.fast = _lane("fast", threads, queue_size)
+        self.slow = _lane("slow", slow_threads, slow_queue_size)
+        self.drain_timeout = drain_timeout
+        self.draining = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def shutdown(self):
+        # Refuse new work, let in-flight requests finish, then stop the pools
+        from _db_helper import _db
+        from _hasher import _hasher
+        from _reports import _reports
+        self.draining = True
+        deadline = asyncio.get_running_loop().time() + self.drain_timeout
+        while (self.fast.in_flight or self.slow.in_flight) and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.fast.in_flight or self.slow.in_flight:
+            logger.warning("Shutting down with %s requests still running", self.fast.in_flight + self.slow.in_flight)
+        for lane in (self.fast, self.slow):
+            lane.executor.shutdown(wait=False, cancel_futures=True)
+        _reports.shutdown(wait=True)
+        _hasher.shutdown(wait=True)
+        _db.close_pool()
+
+    def collect(self):
+        # Lane gauges for /metrics
+        samples = []
+        for field, kind in (("in_flight", "gauge"), ("capacity", "gauge"), ("rejected", "counter")):
+            suffix = "_total" if kind == "counter" else ""
+            samples.append((f"claims_serve_{field}{suffix}", kind, f"Serving lane {field.replace('_', ' ')}",
+                            [({"lane": lane.name}, lane.stats()[field]) for lane in (self.fast, self.slow)]))
+        return samples
+
+    def lane_for(self, path):
+        return self.slow if path.startswith(self.slow_prefixes) else self.fast
+
+    async def reject(self, send, message):
+        body = ('{"error": true, "message": "%s"}\n' % message).encode()
+        await send({"type": "http.response.start", "status": 503, "headers": [
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), (b"retry-after", b"1")]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def read_body(self, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            body.write(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        size = body.tell()
+        body.seek(0)
+        return body, size
+
+    def environ(self, scope, body, size):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+            "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+            "QUERY_STRING": scope["query_string"].decode("latin1"),
+            "SERVER_NAME": server[0],
+            "SERVER_PORT": str(server[1]),
+            "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(size),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            # Files sent by the application are read in response-sized blocks
+            "wsgi.file_wrapper": lambda file, block_size=None: FileWrapper(file, self.chunk_size),
+        }
+        for name, value in scope["headers"]:
+            name = name.decode("latin1").upper().replace("-", "_")
+            value = value.decode("latin1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    def start(self, environ):
+        # Runs on a lane thread: call the application and gather the first chunk
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in headers]
+            return lambda data: None
+
+        iterable = self.wsgi_app(environ, start_response)
+        iterator = iter(iterable)
+        chunk, done = self.next_chunk(iterator)
+        return started, iterable, iterator, chunk, done
+
+    def next_chunk(self, iterator):
+        # Runs on a lane thread: gather up to chunk_size bytes from the response
+        buffer = io.BytesIO()
+        for data in iterator:
+            buffer.write(data)
+            if buffer.tell() >= self.chunk_size:
+                return buffer.getvalue(), False
+        return buffer.getvalue(), True
+
+    async def http(self, scope, receive, send):
+        if self.draining:
+            await self.reject(send, "server is shutting down")
+            return
+        lane = self.lane_for(scope["path"])
+        if not lane.try_admit():
+            await self.reject(send, "server is busy, retry shortly")
+            return
+        loop = asyncio.get_running_loop()
+        # Every step of one response runs in the same context, whichever lane
+        # thread picks it up, so context variables the application sets while
+        # streaming (Flask's stream_with_context) are reset where they were set
+        context = contextvars.copy_context()
+        iterable = None
+        try:
+            request_body = await self.read_body(receive)
+            if request_body is None:
+                return
+            environ = self.environ(scope, *request_body)
+            started, iterable, iterator, chunk, done = await loop.run_in_executor(lane.executor, context.run, self.start, environ)
+            await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+            while not done:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk, done = await loop.run_in_executor(lane.executor, context.run, self.next_chunk, iterator)
+            await send({"type": "http.response.body", "body": chunk})
+        finally:
+            if iterable is not None and hasattr(iterable, "close"):
+                await loop.run_in_executor(lane.executor, context.run, iterable.close)
+            lane.release()
+
+
+def create_asgi_app():
+    # Factory used by every server worker process, configured from the environment
+    from app import create_app
+    from _metrics import _metrics
+    server = AsyncServer(
+        create_app(),
+        threads=int(os.environ.get("CLAIMS_SERVE_THREADS", 16)),
+        queue_size=int(os.environ.get("CLAIMS_SERVE_QUEUE", 64)),
+        slow_threads=int(os.environ.get("CLAIMS_SERVE_SLOW_THREADS", 4)),
+        slow_queue_size=int(os.environ.get("CLAIMS_SERVE_SLOW_QUEUE", 16)),
+        drain_timeout=float(os.environ.get("CLAIMS_SERVE_DRAIN_TIMEOUT", 30)),
+    )
+    _metrics.register(server.collect)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the claims API with an async server")
+    parser.add_argument("--host", default=os.environ.get("CLAIMS_SERVE_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CLAIMS_SERVE_PORT", 5000)))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("CLAIMS_SERVE_WORKERS", 1)), help="server processes")
+    parser.add_argument("--threads", type=int, help="threads for fast requests in each process")
+    parser.add_argument("--queue", type=int, help="fast requests allowed to wait for a thread before 503")
+    parser.add_argument("--slow-threads", type=int, help="threads for report and bulk requests in each process")
+    parser.add_argument("--slow-queue", type=int, help="slow requests allowed to wait for a thread before 503")
+    parser.add_argument("--drain-timeout", type=float, help="seconds to let in-flight requests finish on shutdown")
+    args = parser.parse_args(argv)
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("the async serving mode needs uvicorn, install it with 'pip install uvicorn'")
+
+    # Worker processes read their settings from the environment
+    for option, variable in (("threads", "THREADS"), ("queue", "QUEUE"), ("slow_threads", "SLOW_THREADS"),
+                             ("slow_queue", "SLOW_QUEUE"), ("drain_timeout", "DRAIN_TIMEOUT")):
+        if getattr(args, option) is not None:
+            os.environ[f"CLAIMS_SERVE_{variable}"] = str(getattr(args, option))
+    drain_timeout = float(os.environ.get("CLAIMS_SERVE_DRAIN_TIMEOUT", 30))
+    uvicorn.run("serve:create_asgi_app", factory=True, host=args.host, port=args.port, workers=args.workers,
+                timeout_graceful_shutdown=drain_timeout, log_config=None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())